@@ -0,0 +1,301 @@
+"""
+Host-to-peer audio streaming for listeners who don't own the current track.
+
+The host cuts the playing file into fixed-length segments. Segment n is due
+at start_at + n * segment_seconds on the room clock (the relay's clock, see
+clock_offset in the client) and is published STREAM_DELAY seconds before it
+is due. Listeners fetch segments ahead of time into a jitter buffer and hand
+each one to the player just before it is due, so every listener plays the
+same audio at the same room time.
+
+pygame can only play files, not raw PCM, so segments are slices of the
+compressed file written to temp files and queued back to back. That only
+works for formats made of self-contained frames: MP3 slices are cut on frame
+headers and play on their own, while a slice of an OGG, FLAC or WAV file has
+no headers and won't decode, so only STREAMABLE_EXTS can be streamed.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+
+SEGMENT_SECONDS = 2.0   # audio per segment
+STREAM_DELAY = 4.0      # jitter buffer target: how far ahead of playback segments are published
+QUEUE_AHEAD = 0.5       # hand a segment to the player this long before it is due
+FALLBACK_KBPS = 192     # bitrate assumed when the track length can't be read
+STREAMABLE_EXTS = (".mp3",)
+FRAME_SCAN = 8192       # bytes searched for the next MP3 frame header
+
+
+# kbps by [MPEG-1?][layer 1-3][bitrate index]; sample rates by version bits
+BITRATES = {
+    True: {1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+           2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+           3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)},
+    False: {1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+            2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+            3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)},
+}
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def estimate_duration(path):
+    """Track length in seconds, read from the MP3 headers without decoding.
+
+    A Xing/Info header gives the exact frame count (VBR files); otherwise the
+    first frame's bitrate is taken as constant. Files we can't parse assume
+    FALLBACK_KBPS.
+    """
+    size = os.path.getsize(path)
+    try:
+        with open(path, "rb") as f:
+            head = f.read(10)
+            start = 0
+            if head[:3] == b"ID3" and len(head) == 10:
+                start = 10 + ((head[6] & 0x7F) << 21 | (head[7] & 0x7F) << 14 | (head[8] & 0x7F) << 7 | head[9] & 0x7F)
+                if head[5] & 0x10:
+                    start += 10  # footer
+            if not is_frame_header(head[start:start + 4]):
+                start = frame_start(f, max(start, 1))  # skip junk before the first frame
+            f.seek(start)
+            frame = f.read(200)
+        if not is_frame_header(frame[:4]):
+            raise ValueError("no MP3 frame header")
+        version, layer = frame[1] >> 3 & 3, 4 - (frame[1] >> 1 & 3)
+        mpeg1 = version == 3
+        kbps = BITRATES[mpeg1][layer][frame[2] >> 4]
+        rate = SAMPLE_RATES[version][frame[2] >> 2 & 3]
+        samples = 384 if layer == 1 else 1152 if mpeg1 or layer == 2 else 576
+        mono = frame[3] >> 6 == 3
+        xing = 4 + (17 if mono else 32) if mpeg1 else 4 + (9 if mono else 17)
+        if layer == 3 and frame[xing:xing + 4] in (b"Xing", b"Info") and frame[xing + 7] & 1:
+            frames = int.from_bytes(frame[xing + 8:xing + 12], "big")
+            if frames:
+                return frames * samples / rate
+        if kbps:
+            return (size - start) * 8 / (kbps * 1000)
+    except (OSError, ValueError, IndexError, KeyError):
+        pass
+    return size * 8 / (FALLBACK_KBPS * 1000)
+
+
+def segment_count(duration, segment_seconds=SEGMENT_SECONDS):
+    return max(1, int(-(-duration // segment_seconds)))
+
+
+def is_frame_header(b):
+    """True if the 4 bytes look like an MPEG audio frame header."""
+    return (len(b) == 4 and b[0] == 0xFF and b[1] & 0xE0 == 0xE0
+            and b[1] & 0x18 != 0x08 and b[1] & 0x06 != 0
+            and b[2] & 0xF0 not in (0x00, 0xF0) and b[2] & 0x0C != 0x0C)
+
+
+def frame_start(f, offset):
+    """Offset of the first MP3 frame header at or after offset (offset itself if none is found)."""
+    if offset == 0:
+        return 0
+    f.seek(offset)
+    window = f.read(FRAME_SCAN + 3)
+    for i in range(len(window) - 3):
+        if window[i] == 0xFF and is_frame_header(window[i:i + 4]):
+            return offset + i
+    return offset
+
+
+class StreamPublisher(threading.Thread):
+    """Publishes segments of a file on the room clock.
+
+    publish(seq, data) delivers a segment; clock() returns room time.
+    """
+
+    def __init__(self, path, start_at, clock, publish, start_seq=0, segment_seconds=SEGMENT_SECONDS):
+        super().__init__(daemon=True)
+        self.path = path
+        self.start_at = start_at
+        self.clock = clock
+        self.publish = publish
+        self.start_seq = start_seq
+        self.segment_seconds = segment_seconds
+        if os.path.splitext(path)[1].lower() not in STREAMABLE_EXTS:
+            raise ValueError(f"can't stream {os.path.splitext(path)[1] or 'this'} files, only "
+                             f"{', '.join(STREAMABLE_EXTS)}")
+        self.duration = estimate_duration(path)
+        self.segments = segment_count(self.duration, segment_seconds)
+        self.segment_bytes = max(1, int(os.path.getsize(path) / self.segments))
+        self._stop_event = threading.Event()
+
+    def play_at(self, seq):
+        return self.start_at + (seq - self.start_seq) * self.segment_seconds
+
+    def run(self):
+        with open(self.path, "rb") as f:
+            for seq in range(self.start_seq, self.segments):
+                wait = self.play_at(seq) - STREAM_DELAY - self.clock()
+                if wait > 0 and self._stop_event.wait(wait):
+                    return
+                if self._stop_event.is_set():
+                    return
+                # Cut on frame headers so every segment decodes on its own
+                begin = frame_start(f, seq * self.segment_bytes)
+                end = frame_start(f, (seq + 1) * self.segment_bytes) if seq < self.segments - 1 else None
+                f.seek(begin)
+                data = f.read(end - begin if end is not None else -1)
+                try:
+                    self.publish(seq, data)
+                except Exception as e:
+                    print(f"⚠️ Stream segment {seq} not published: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class JitterBuffer:
+    """Segments waiting for their play time, plus the numbers to tune it by."""
+
+    def __init__(self, start_at, start_seq=0, segment_seconds=SEGMENT_SECONDS):
+        self.start_at = start_at
+        self.segment_seconds = segment_seconds
+        self.next_seq = start_seq
+        self.start_seq = start_seq
+        self.segments = {}
+        self.lock = threading.Lock()
+        self.underruns = 0
+        self.late_drops = 0
+        self._underrun_seq = None
+        self.arrival_lag = []     # seconds between nominal publish time and arrival
+        self.play_latency = []    # seconds between nominal publish time and hand-off to the player
+
+    def play_at(self, seq):
+        return self.start_at + (seq - self.start_seq) * self.segment_seconds
+
+    def push(self, seq, data, now):
+        with self.lock:
+            if seq < self.next_seq or seq in self.segments:
+                return
+            self.segments[seq] = data
+            self.arrival_lag.append(now - (self.play_at(seq) - STREAM_DELAY))
+
+    def pop_due(self, now):
+        """(seq, data) to hand to the player now, or None.
+
+        A segment that is missing at its due time counts as an underrun; one
+        that is still missing a full segment later is skipped so playback
+        stays aligned with the room instead of drifting behind.
+        """
+        with self.lock:
+            due = self.play_at(self.next_seq)
+            if now < due - QUEUE_AHEAD:
+                return None
+            data = self.segments.pop(self.next_seq, None)
+            if data is None:
+                if now >= due and self._underrun_seq != self.next_seq:
+                    self.underruns += 1
+                    self._underrun_seq = self.next_seq
+                if now >= due + self.segment_seconds:
+                    self.late_drops += 1
+                    self.next_seq += 1
+                return None
+            seq = self.next_seq
+            self.next_seq += 1
+            self.play_latency.append(now - (due - STREAM_DELAY))
+            return seq, data
+
+    def depth(self):
+        """Seconds of audio buffered ahead of the play head."""
+        with self.lock:
+            return len(self.segments) * self.segment_seconds
+
+    def stats(self):
+        def avg(values):
+            return sum(values[-50:]) / len(values[-50:]) if values else 0.0
+        return {
+            "depth": self.depth(),
+            "underruns": self.underruns,
+            "late_drops": self.late_drops,
+            "arrival_lag_ms": int(avg(self.arrival_lag) * 1000),
+            "latency_ms": int(avg(self.play_latency) * 1000),
+        }
+
+
+class StreamListener:
+    """Fetches a host's stream into a JitterBuffer and feeds the player.
+
+    fetch(seq) returns segment bytes or None if not published yet.
+    player has play(path), queue(path) and is_busy().
+    """
+
+    def __init__(self, info, clock, fetch, player, ext=".mp3"):
+        self.info = info
+        self.clock = clock
+        self.fetch = fetch
+        self.player = player
+        self.ext = ext
+        self.buffer = JitterBuffer(info["start_at"], info.get("start_seq", 0),
+                                   info.get("segment_seconds", SEGMENT_SECONDS))
+        self.end_seq = info["segments"]
+        self.temp_dir = tempfile.mkdtemp(prefix="music_sync_stream_")
+        self._stop_event = threading.Event()
+        self._files = []
+
+    def start(self):
+        threading.Thread(target=self._fetch_loop, daemon=True).start()
+        threading.Thread(target=self._play_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _fetch_loop(self):
+        seq = self.buffer.next_seq
+        while not self._stop_event.is_set() and seq < self.end_seq:
+            # Don't fetch further ahead than the publisher has published
+            if self.buffer.play_at(seq) - STREAM_DELAY > self.clock():
+                self._stop_event.wait(0.1)
+                continue
+            if seq < self.buffer.next_seq:
+                seq = self.buffer.next_seq  # skipped as late, don't bother fetching
+                continue
+            try:
+                data = self.fetch(seq)
+            except Exception as e:
+                print(f"⚠️ Stream fetch {seq} failed: {e}")
+                data = None
+            if data is None:
+                self._stop_event.wait(0.2)
+                continue
+            self.buffer.push(seq, data, self.clock())
+            seq += 1
+
+    def _play_loop(self):
+        while not self._stop_event.is_set() and self.buffer.next_seq < self.end_seq:
+            item = self.buffer.pop_due(self.clock())
+            if item is None:
+                self._stop_event.wait(0.05)
+                continue
+            seq, data = item
+            path = os.path.join(self.temp_dir, f"{seq}{self.ext}")
+            try:
+                with open(path, "wb") as f:
+                    f.write(data)
+                if self.player.is_busy():
+                    self.player.queue(path)
+                else:
+                    # Wait for the exact due time so we start aligned with the room
+                    delay = self.buffer.play_at(seq) - self.clock()
+                    if delay > 0:
+                        self._stop_event.wait(delay)
+                    self.player.play(path)
+            except Exception as e:
+                # One bad segment is a gap in the audio, not the end of the stream
+                print(f"⚠️ Stream segment {seq} not played: {e}")
+            self._cleanup(path)
+
+    def _cleanup(self, path):
+        self._files.append(path)
+        while len(self._files) > 3:
+            try:
+                os.remove(self._files.pop(0))
+            except OSError:
+                pass
@@ -0,0 +1,232 @@
+"""
+LAN mode: sessions on the local network without the cloud relay.
+
+One client runs a LanHub, a small embedded relay that accepts direct TCP
+connections from peers and fans every command out to the rest of the room.
+The hub announces itself with UDP broadcast beacons so peers can find it
+with discover_rooms(). Messages are newline-delimited JSON with Nagle
+disabled, so a command reaches the room in a couple of milliseconds and
+nothing depends on an internet connection.
+"""
+
+import json
+import socket
+import threading
+import time
+
+DISCOVERY_PORT = 47474
+BEACON_INTERVAL = 1.0   # seconds between hub announcements
+CLOCK_PING_INTERVAL = 5.0
+APP_TAG = "music_sync"
+
+
+def _encode(msg):
+    return (json.dumps(msg) + "\n").encode("utf-8")
+
+
+class LanHub:
+    """Host side: embedded relay for the room.
+
+    on_command(msg) is called for every command a peer sends (the hub's own
+    commands are not echoed back to it).
+    """
+
+    def __init__(self, room_code, on_command, port=0, name=""):
+        self.room_code = room_code
+        self.on_command = on_command
+        self.name = name
+        self.server = socket.create_server(("", port))
+        self.port = self.server.getsockname()[1]
+        self.peers = []
+        self.send_locks = {}   # peer -> lock, so two threads never interleave lines on one socket
+        self.lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        threading.Thread(target=self._beacon_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        try:
+            self.server.close()
+        except OSError:
+            pass
+        with self.lock:
+            for peer in self.peers:
+                peer.close()
+            self.peers = []
+            self.send_locks = {}
+
+    def send(self, msg):
+        """Send one of our own commands to every peer."""
+        msg = dict(msg, timestamp=time.time())
+        self._fanout(msg)
+
+    def _fanout(self, msg, exclude=None):
+        data = _encode(msg)
+        with self.lock:
+            peers = [(peer, self.send_locks[peer]) for peer in self.peers if peer is not exclude]
+        for peer, send_lock in peers:
+            self._send_to(peer, send_lock, data)
+
+    def _send_to(self, peer, send_lock, data):
+        try:
+            with send_lock:
+                peer.sendall(data)
+        except OSError:
+            self._drop(peer)
+
+    def _drop(self, peer):
+        with self.lock:
+            if peer in self.peers:
+                self.peers.remove(peer)
+            self.send_locks.pop(peer, None)
+        try:
+            peer.close()
+        except OSError:
+            pass
+
+    def _accept_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            send_lock = threading.Lock()
+            with self.lock:
+                self.peers.append(conn)
+                self.send_locks[conn] = send_lock
+            threading.Thread(target=self._serve_peer, args=(conn, send_lock), daemon=True).start()
+
+    def _serve_peer(self, conn, send_lock):
+        try:
+            for line in conn.makefile("r", encoding="utf-8"):
+                try:
+                    msg = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(msg, dict):
+                    continue
+                if msg.get("type") == "ping":
+                    # Clock sample for the peer's room clock
+                    with send_lock:
+                        conn.sendall(_encode({"type": "pong", "sent_at": msg.get("sent_at"), "server": time.time()}))
+                    continue
+                msg["timestamp"] = time.time()
+                self._fanout(msg, exclude=conn)
+                self.on_command(msg)
+        except OSError:
+            pass
+        finally:
+            self._drop(conn)
+
+    def _beacon_loop(self):
+        beacon = json.dumps({"app": APP_TAG, "room_code": self.room_code,
+                             "port": self.port, "name": self.name}).encode("utf-8")
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            while not self._stop_event.wait(BEACON_INTERVAL):
+                try:
+                    sock.sendto(beacon, ("<broadcast>", DISCOVERY_PORT))
+                except OSError:
+                    pass  # No broadcast route (e.g. offline), keep trying
+
+
+class LanClient:
+    """Peer side: direct TCP connection to a LanHub.
+
+    on_command(msg) gets every command from the room, on_clock(sent_at,
+    received_at, server_time) gets clock samples, on_disconnect() fires
+    when the hub goes away.
+    """
+
+    def __init__(self, host, port, on_command, on_clock=None, on_disconnect=None):
+        self.on_command = on_command
+        self.on_clock = on_clock
+        self.on_disconnect = on_disconnect
+        self.sock = socket.create_connection((host, port), timeout=3)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        threading.Thread(target=self._ping_loop, daemon=True).start()
+        return self
+
+    def send(self, msg):
+        with self.send_lock:
+            self.sock.sendall(_encode(msg))
+
+    def close(self):
+        self._stop_event.set()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def _read_loop(self):
+        try:
+            for line in self.sock.makefile("r", encoding="utf-8"):
+                try:
+                    msg = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(msg, dict):
+                    continue
+                if msg.get("type") == "pong":
+                    if self.on_clock and msg.get("sent_at"):
+                        self.on_clock(msg["sent_at"], time.time(), msg["server"])
+                    continue
+                self.on_command(msg)
+        except OSError:
+            pass
+        if not self._stop_event.is_set() and self.on_disconnect:
+            self.on_disconnect()
+
+    def _ping_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                self.send({"type": "ping", "sent_at": time.time()})
+            except OSError:
+                return
+            self._stop_event.wait(CLOCK_PING_INTERVAL)
+
+
+def discover_rooms(timeout=2.0):
+    """Listen for hub beacons; returns [{"room_code", "host", "port", "name"}]."""
+    rooms = {}
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("", DISCOVERY_PORT))
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, (host, _) = sock.recvfrom(4096)
+            except socket.timeout:
+                break
+            try:
+                beacon = json.loads(data)
+            except ValueError:  # not JSON, or not even UTF-8: some other app's broadcast
+                continue
+            if not isinstance(beacon, dict) or beacon.get("app") != APP_TAG:
+                continue
+            room_code, port = beacon.get("room_code"), beacon.get("port")
+            if isinstance(room_code, str) and isinstance(port, int):
+                rooms[room_code] = {
+                    "room_code": room_code,
+                    "host": host,
+                    "port": port,
+                    "name": str(beacon.get("name", "")),
+                }
+    return list(rooms.values())
@@ -0,0 +1,142 @@
+"""
+Client-side helpers for talking to the relay.
+
+PollScheduler decides how long to wait between /receive polls: fast right
+after local or remote activity, exponentially slower (with jitter) while the
+room is idle or the relay keeps failing, never slower than a ceiling.
+
+OutboundJournal holds commands that couldn't be sent while the relay was
+unreachable, collapsed to what still matters, for replay in order once it
+is back. Every command carries an "id" idempotency key so the relay can
+tell a replay from a new command.
+"""
+
+import random
+import threading
+import time
+import uuid
+
+POLL_FAST_INTERVAL = 0.5    # seconds between polls while the room is active
+POLL_MAX_INTERVAL = 15.0    # ceiling for an idle room
+POLL_ERROR_CEILING = 30.0   # ceiling while the relay is failing
+FAST_MODE_WINDOW = 15.0     # seconds of fast polling after the last activity
+IDLE_BACKOFF = 1.5          # interval growth per quiet poll once the window has passed
+POLL_JITTER = 0.2           # +/- fraction so clients don't poll in lockstep
+JOURNAL_LIMIT = 200         # outbound commands kept while offline
+
+TRANSPORT_COMMANDS = {"play", "next", "prev", "stop", "pause", "unpause"}
+OPPOSITES = {"pause": "unpause", "unpause": "pause"}
+
+
+class PollScheduler:
+    def __init__(self, fast=POLL_FAST_INTERVAL, ceiling=POLL_MAX_INTERVAL,
+                 error_ceiling=POLL_ERROR_CEILING, fast_window=FAST_MODE_WINDOW,
+                 clock=time.monotonic, rng=random.random):
+        self.fast = fast
+        self.ceiling = ceiling
+        self.error_ceiling = error_ceiling
+        self.fast_window = fast_window
+        self.clock = clock
+        self.rng = rng
+        self.interval = fast
+        self.errors = 0
+        self.last_activity = clock()
+        self._wake = threading.Event()
+
+    def note_activity(self):
+        """Local command sent or remote command received: poll fast again, starting now."""
+        self.last_activity = self.clock()
+        if not self.errors:
+            self.interval = self.fast
+            self._wake.set()
+
+    def note_success(self, got_commands):
+        self.errors = 0
+        if got_commands:
+            self.last_activity = self.clock()
+        if self.clock() - self.last_activity < self.fast_window:
+            self.interval = self.fast
+        else:
+            self.interval = min(self.ceiling, self.interval * IDLE_BACKOFF)
+
+    def note_error(self):
+        self.errors += 1
+        self.interval = min(self.error_ceiling, max(self.interval, self.fast) * 2)
+
+    def next_delay(self):
+        return self.interval * (1 + POLL_JITTER * (2 * self.rng() - 1))
+
+    def wait(self):
+        """Sleep until the next poll is due, or until activity cuts the wait short."""
+        self._wake.wait(self.next_delay())
+        self._wake.clear()
+
+
+def new_command_id():
+    return uuid.uuid4().hex[:16]
+
+
+class OutboundJournal:
+    """Bounded, collapsing queue of commands waiting for the relay."""
+
+    def __init__(self, limit=JOURNAL_LIMIT):
+        self.limit = limit
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def add(self, payload):
+        """Queue a command, dropping whatever it makes redundant."""
+        payload.setdefault("id", new_command_id())
+        command = payload.get("command")
+        with self.lock:
+            entries = self.entries
+            transport = [e for e in entries if e.get("command") in TRANSPORT_COMMANDS]
+            if command in OPPOSITES:
+                # pause then unpause (or the reverse) cancels out
+                if transport and transport[-1].get("command") == OPPOSITES[command]:
+                    entries.remove(transport[-1])
+                    return
+            elif command in TRANSPORT_COMMANDS:
+                # A new play/next/prev/stop decides the transport state on its own
+                entries[:] = [e for e in entries if e not in transport]
+            elif command == "sync_playlist" and (payload.get("data") or {}).get("queue_state") is not None:
+                # Only the final queue state of a series of edits is needed
+                entries[:] = [e for e in entries if e.get("command") not in ("queue_ops", "sync_playlist")]
+            entries.append(payload)
+            if len(entries) > self.limit:
+                dropped = entries.pop(0)
+                print(f"⚠️ Offline journal full, dropped: {dropped.get('command')}")
+
+    def flush(self, send):
+        """Replay in order with send(payload) -> bool; stops at the first failure.
+
+        Returns how many commands were delivered.
+        """
+        sent = 0
+        while True:
+            with self.lock:
+                if not self.entries:
+                    return sent
+                payload = self.entries[0]
+            if not send(payload):
+                return sent
+            with self.lock:
+                if self.entries and self.entries[0] is payload:
+                    self.entries.pop(0)
+            sent += 1
+
+
+if __name__ == "__main__":
+    # Polls per hour for an idle room vs. the old fixed 2 s interval
+    now = [0.0]
+    scheduler = PollScheduler(clock=lambda: now[0], rng=lambda: 0.5)
+    polls = 0
+    while now[0] < 3600:
+        scheduler.note_success(False)
+        now[0] += scheduler.next_delay()
+        polls += 1
+    print(f"idle room: {polls} polls/hour (fixed 2 s interval: {3600 // 2})")
@@ -0,0 +1,812 @@
+"""
+Room and command logic of the relay, independent of any web framework.
+
+relay_server.py exposes a RelayCore through Flask routes. The same core can
+also be served from a background thread with serve_in_background() (plain
+http.server, no Flask needed), which is how a client hosts its own room and
+how tests and benchmarks run a relay in-process. Both speak the same wire
+API:
+
+    POST /host {"room_code"?, "client"?}  -> {"room_code", "epoch", "seq", "host", "timestamp"}
+    POST /join/<room> {"client"?}  -> {"status", "room_code", "epoch", "seq", "host", "timestamp"}
+    POST /send/<room>            {"command", "index"?, "data"?, "id"?, "origin"?, "to"?}
+    GET  /receive/<room>?after=&client=  -> {"commands", "epoch", "seq", "gap", "host", "timestamp"}
+    PUT  /blob/<room>/<key>      raw bytes
+    GET  /blob/<room>/<key>      raw bytes
+    GET  /members/<room>         -> {"members": [{"client", "last_seen", "cursor", "lag", ...}], "host", "seq"}
+    GET  /ping, GET /rooms
+    GET  /metrics                Prometheus text (relay_metrics.py)
+    GET  /ring, POST /ring       node list of a sharded relay (relay_ring.py)
+
+Core methods return (payload, status); payload is a dict for JSON replies or
+bytes for blobs. A client polls with after=<last seq it applied>; gap=true
+means part of that was pruned (or the room was recreated) and it should
+fetch a snapshot from its peers.
+
+See relay_store.py (warm restart), relay_shared.py (several workers) and
+relay_ring.py (several nodes).
+
+Run this file directly to self-host a relay without Flask.
+"""
+
+import json
+import logging
+import math
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from relay_log import log_event
+from relay_metrics import Metrics
+
+ROOM_TIMEOUT = 3600  # 1 hour
+COMMAND_RETENTION = 120  # seconds a command stays available when no member cursors are known
+MIN_COMMAND_RETENTION = 5  # seconds a command is kept even once every member has read it
+MAX_COMMAND_RETENTION = 600  # seconds a command waits for the slowest member at most
+MEMBER_TIMEOUT = 90  # seconds without a poll before a member counts as gone
+BLOB_TTL = 300  # seconds an uploaded track chunk is kept
+MAX_BLOB_SIZE = 1024 * 1024  # bytes per blob
+DEDUPE_WINDOW = 1024  # command ids remembered per room
+MAX_COMMAND_SIZE = 512 * 1024  # bytes per stored command (JSON)
+MAX_ROOM_COMMANDS = 1000  # commands kept per room at most
+ROOM_MEMORY_BUDGET = 16 * 1024 * 1024  # bytes of commands per room
+BLOB_MEMORY_BUDGET = 8 * 1024 * 1024  # bytes of blobs per room, kept apart so tracks never evict commands
+GLOBAL_MEMORY_BUDGET = 256 * 1024 * 1024  # bytes across all rooms
+SEND_RATE = 20  # commands per second per sender, sustained
+SEND_BURST = 40
+BLOB_RATE = 50  # blob uploads per second per room, sustained
+BLOB_BURST = 100
+
+TRACK_COMMANDS = {"play", "next", "prev", "stop"}
+PAUSE_COMMANDS = {"pause", "unpause"}
+
+
+class RecentIds:
+    """Bounded LRU set of command ids, each mapped to a value (e.g. its seq)."""
+
+    def __init__(self, limit=DEDUPE_WINDOW):
+        self.limit = limit
+        self.ids = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.ids:
+                return None
+            self.ids.move_to_end(key)
+            return self.ids[key]
+
+    def add(self, key, value=True):
+        with self.lock:
+            self.ids[key] = value
+            self.ids.move_to_end(key)
+            if len(self.ids) > self.limit:
+                self.ids.popitem(last=False)
+
+    def seen(self, key):
+        """True if key was added before; otherwise adds it and returns False."""
+        with self.lock:
+            if key in self.ids:
+                self.ids.move_to_end(key)
+                return True
+            self.ids[key] = True
+            if len(self.ids) > self.limit:
+                self.ids.popitem(last=False)
+            return False
+
+
+class RateLimiter:
+    """Token buckets keyed by sender."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # key -> (tokens, last refill)
+
+    def acquire(self, key, now):
+        """0 if allowed, else seconds until the next token."""
+        tokens, last = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self.buckets[key] = (tokens - 1, now)
+        if len(self.buckets) > 10000:
+            # Forget buckets that have been full (idle) for a while
+            self.buckets = {k: v for k, v in self.buckets.items() if now - v[1] < self.burst / self.rate}
+        return 0
+
+
+def build_command(data):
+    """The stored form of a /send body (ValueError if it is malformed)."""
+    data = data or {}
+    if not isinstance(data, dict):
+        raise ValueError("command must be a JSON object")
+    index = data.get("index")
+    extra_data = data.get("data")  # Get the data field
+
+    # Store command with optional index and data
+    cmd_data = {"command": data.get("command")}
+    if data.get("id"):
+        cmd_data["id"] = data["id"]
+    if data.get("origin"):
+        cmd_data["origin"] = data["origin"]
+        cmd_data["origin_seq"] = data.get("origin_seq")
+    if data.get("to") is not None:
+        if not isinstance(data["to"], list) or not all(isinstance(m, str) for m in data["to"]):
+            raise ValueError("to must be a list of member ids")
+        cmd_data["to"] = list(data["to"])  # member ids it is addressed to
+    if index is not None:
+        cmd_data["index"] = index
+    if extra_data is not None:
+        cmd_data["data"] = extra_data  # Include the data field
+    return cmd_data
+
+
+def json_object(body):
+    """Parse a request body that must be a JSON object; no body is {}."""
+    data = json.loads(body or b"{}")
+    if not isinstance(data, dict):
+        raise ValueError("request body must be a JSON object")
+    return data
+
+
+def is_queue_snapshot(cmd_data):
+    """A sync_playlist carrying the full queue state (newer ones replace older ones)."""
+    return cmd_data.get("command") == "sync_playlist" and (cmd_data.get("data") or {}).get("queue_state") is not None
+
+
+def rate_limited(wait):
+    return {"error": "Rate limited", "retry_after": round(wait, 3)}, 429
+
+
+class RelayCore:
+    def __init__(self, room_timeout=ROOM_TIMEOUT, command_retention=COMMAND_RETENTION,
+                 blob_ttl=BLOB_TTL, max_blob_size=MAX_BLOB_SIZE, member_timeout=MEMBER_TIMEOUT,
+                 max_command_retention=MAX_COMMAND_RETENTION, room_budget=ROOM_MEMORY_BUDGET,
+                 global_budget=GLOBAL_MEMORY_BUDGET, max_command_size=MAX_COMMAND_SIZE,
+                 blob_budget=BLOB_MEMORY_BUDGET, store=None):
+        self.room_timeout = room_timeout
+        self.command_retention = command_retention
+        self.max_command_retention = max_command_retention
+        self.member_timeout = member_timeout
+        self.blob_ttl = blob_ttl
+        self.max_blob_size = max_blob_size
+        self.max_command_size = max_command_size
+        self.room_budget = room_budget
+        self.blob_budget = blob_budget
+        self.global_budget = global_budget
+        self.used_bytes = 0  # stored payload bytes across all rooms
+        self.send_limiter = RateLimiter(SEND_RATE, SEND_BURST)
+        self.blob_limiter = RateLimiter(BLOB_RATE, BLOB_BURST)
+        self.rooms = {}
+        self.lock = threading.Lock()
+        self.metrics = Metrics()
+        self.store = store
+        if store is not None:
+            self._restore(store.load())
+
+    def _restore(self, stored):
+        """Rebuild rooms saved by the store (warm restart).
+
+        Only the indexes are rebuilt here; a room's command bodies are parsed
+        the first time the room is used (see _room), which keeps a restart
+        with thousands of rooms well under a second.
+
+        Members aren't saved, so a restored room counts as active from the
+        restart and its host is seeded as a member: if nobody comes back,
+        the host expires like any member and the room after it.
+        """
+        now = time.time()
+        for code, saved in stored.items():
+            room = self._new_room(code, saved["epoch"], saved["host"], saved["created_at"])
+            room["restored_at"] = now
+            if saved["host"]:
+                room["members"][saved["host"]] = {"joined_at": now, "last_seen": now, "cursor": None}
+            room["seq"] = saved["seq"]
+            room["floor"] = saved["floor"]
+            room["unparsed"] = saved["commands"]
+            for seq, command_id, body in saved["commands"]:
+                room["sizes"][seq] = len(body)
+                self._account(room, len(body))
+                if command_id:
+                    room["recent_ids"].add(command_id, seq)
+            self.rooms[code] = room
+        if stored:
+            log_event(logging.INFO, "rooms_restored", rooms=len(stored))
+
+    def _room(self, room_code):
+        """The room for a request, with its restored command log parsed."""
+        room = self.rooms.get(room_code)
+        if room is not None and room["unparsed"]:
+            with self.lock:
+                self._parse_restored(room)
+        return room
+
+    def _parse_restored(self, room):
+        if room["unparsed"]:
+            bodies = ",".join(body for _, _, body in room["unparsed"])
+            room["commands"] = json.loads("[" + bodies + "]") + room["commands"]
+            room["unparsed"] = None
+
+    def _new_room(self, code, epoch, host, created_at):
+        return {
+            "code": code,
+            "commands": [],
+            "unparsed": None,  # (seq, id, body) of a restored log not parsed yet
+            "blobs": {},
+            "members": {},  # client id -> {"last_seen", "cursor", "joined_at"}
+            "recent_ids": RecentIds(),  # command id -> seq, for retried sends
+            "epoch": epoch,
+            "seq": 0,  # sequence number of the newest command
+            "floor": 0,  # highest seq pruned from the log (compaction doesn't count)
+            "sizes": {},  # seq -> stored bytes of that command
+            "bytes": 0,  # stored bytes of commands + blobs
+            "blob_bytes": 0,  # the blobs' share of bytes
+            "host": host,  # member with authority over playback
+            "created_at": created_at
+        }
+
+    # ----- rooms -----
+
+    def host(self, room_code=None, client=None):
+        """Create a room; room_code recreates a known room after a relay restart."""
+        with self.lock:
+            if room_code is None:
+                room_code = str(uuid.uuid4())[:6].upper()  # 6-character room code
+                while room_code in self.rooms:
+                    room_code = str(uuid.uuid4())[:6].upper()
+            elif room_code in self.rooms:
+                return {"error": "Room already exists"}, 409
+            room = self.rooms[room_code] = self._new_room(room_code, uuid.uuid4().hex[:8], client, time.time())
+            if self.store is not None:
+                self.store.room_saved(room_code, room)
+            if client:
+                self._touch_member(room, client, 0, time.time())
+            return {"room_code": room_code, "epoch": room["epoch"], "seq": 0, "host": client,
+                    "timestamp": time.time()}, 200
+
+    def join(self, room_code, client=None):
+        room = self._room(room_code)
+        if room is None:
+            return {"error": "Room not found"}, 404
+        with self.lock:
+            if client:
+                self._touch_member(room, client, room["seq"], time.time())
+                if room.get("host") is None:
+                    self._promote_host(room, time.time())
+            seq = room["seq"]
+        return {"status": "joined", "room_code": room_code, "epoch": room["epoch"],
+                "seq": seq, "host": room.get("host"), "timestamp": time.time()}, 200
+
+    # ----- members -----
+
+    def _touch_member(self, room, client, cursor, now):
+        member = room["members"].setdefault(client, {"joined_at": now, "cursor": None})
+        member["last_seen"] = now
+        if cursor is not None:
+            member["cursor"] = cursor
+
+    def _active_members(self, room, now):
+        """Drop members that stopped polling; returns the rest."""
+        members = room["members"]
+        for client in [c for c, m in members.items() if now - m["last_seen"] > self.member_timeout]:
+            del members[client]
+            self.metrics.inc("relay_members_expired_total")
+            log_event(logging.INFO, "member_left", room=room["code"], client=client, silent_for=self.member_timeout)
+            if client == room.get("host"):
+                self._promote_host(room, now)
+        return members
+
+    def _promote_host(self, room, now):
+        """Hand host authority to the longest-standing member (deterministic)."""
+        previous = room.get("host")
+        members = room["members"]
+        new_host = min(members, key=lambda c: (members[c]["joined_at"], c)) if members else None
+        room["host"] = new_host
+        if self.store is not None:
+            self.store.room_saved(room["code"], room)
+        if new_host is not None:
+            self._append(room, {"command": "host_changed",
+                                "data": {"host": new_host, "previous": previous}}, now)
+            self.metrics.inc("relay_hosts_promoted_total")
+            log_event(logging.INFO, "host_promoted", room=room["code"], previous=previous, host=new_host)
+
+    def members(self, room_code):
+        """Who is in the room, when we last heard from them and how far behind the log they are."""
+        room = self._room(room_code)
+        if room is None:
+            return {"error": "Room not found"}, 404
+        with self.lock:
+            now = time.time()
+            members = self._active_members(room, now)
+            by_seq = {c["seq"]: c["timestamp"] for c in room["commands"]}
+            result = []
+            for client, member in members.items():
+                cursor = member["cursor"]
+                lag = room["seq"] - cursor if cursor is not None else None
+                # Age of the oldest command the member hasn't read yet
+                oldest_unread = by_seq.get(cursor + 1) if lag else None
+                result.append({
+                    "client": client,
+                    "last_seen": member["last_seen"],
+                    "joined_at": member["joined_at"],
+                    "cursor": cursor,
+                    "lag": lag,
+                    "lag_seconds": round(now - oldest_unread, 3) if oldest_unread else 0.0,
+                })
+            return {"members": result, "host": room.get("host"), "seq": room["seq"], "timestamp": now}, 200
+
+    def _prune_commands(self, room, now):
+        """Drop commands every active member has read (or that waited too long)."""
+        commands = room["commands"]
+        cursors = [m["cursor"] for m in self._active_members(room, now).values()]
+        if cursors and None not in cursors:
+            slowest = min(cursors)
+            while commands and (now - commands[0]["timestamp"] > self.max_command_retention or
+                                (commands[0]["seq"] <= slowest and
+                                 now - commands[0]["timestamp"] > MIN_COMMAND_RETENTION)):
+                self._evict_command(room)
+        else:
+            # Someone polls by timestamp only (or nobody is known): keep by age
+            while commands and now - commands[0]["timestamp"] > self.command_retention:
+                self._evict_command(room)
+
+    # ----- memory -----
+
+    def _account(self, room, delta):
+        room["bytes"] += delta
+        self.used_bytes += delta
+
+    def _forget_command(self, room, cmd):
+        self._account(room, -room["sizes"].pop(cmd["seq"], 0))
+        if self.store is not None:
+            self.store.command_removed(room["code"], room, cmd["seq"])
+
+    def _evict_command(self, room):
+        """Drop the oldest command; members behind it will see a gap."""
+        cmd = room["commands"].pop(0)
+        room["floor"] = cmd["seq"]
+        self._forget_command(room, cmd)
+        self.metrics.inc("relay_commands_pruned_total")
+
+    def _account_blob(self, room, delta):
+        room["blob_bytes"] += delta
+        self._account(room, delta)
+
+    def _evict_blob(self, room):
+        oldest = min(room["blobs"], key=lambda k: room["blobs"][k][1])
+        self._account_blob(room, -len(room["blobs"].pop(oldest)[0]))
+
+    def _evict_oldest(self, room):
+        self._parse_restored(room)
+        # Blobs can be uploaded again, the command log can't
+        if room["blobs"]:
+            self._evict_blob(room)
+        elif room["commands"]:
+            self._evict_command(room)
+        else:
+            return False
+        return True
+
+    def _enforce_budgets(self, room):
+        self._parse_restored(room)
+        # Too many commands is fixed by dropping commands; blobs only go for bytes
+        while len(room["commands"]) > MAX_ROOM_COMMANDS:
+            self._evict_command(room)
+        # Blobs and commands have separate budgets: a big track only pushes out older chunks
+        while room["blob_bytes"] > self.blob_budget:
+            self._evict_blob(room)
+        while room["commands"] and room["bytes"] - room["blob_bytes"] > self.room_budget:
+            self._evict_command(room)
+        while self.used_bytes > self.global_budget:
+            biggest = max(self.rooms.values(), key=lambda r: r["bytes"])
+            if not self._evict_oldest(biggest):
+                break
+
+    def _compact(self, room, cmd_data):
+        """Drop logged commands that cmd_data supersedes."""
+        command = cmd_data["command"]
+        if command in TRACK_COMMANDS:
+            superseded = lambda c: c["command"] in TRACK_COMMANDS or c["command"] in PAUSE_COMMANDS
+        elif command in PAUSE_COMMANDS:
+            # Only the pause state since the last track change matters
+            track_seq = next((c["seq"] for c in reversed(room["commands"])
+                              if c["command"] in TRACK_COMMANDS), 0)
+            superseded = lambda c: c["command"] in PAUSE_COMMANDS and c["seq"] > track_seq
+        elif is_queue_snapshot(cmd_data):
+            origin = cmd_data.get("origin")
+            superseded = lambda c: is_queue_snapshot(c) and c.get("origin") == origin
+        else:
+            return
+        kept = []
+        for c in room["commands"]:
+            if "to" in c or not superseded(c):
+                kept.append(c)
+            else:
+                self._forget_command(room, c)
+        if len(kept) < len(room["commands"]):
+            self.metrics.inc("relay_commands_compacted_total", amount=len(room["commands"]) - len(kept))
+        room["commands"] = kept
+
+    def list_rooms(self):
+        """List active rooms (for debugging)."""
+        return {"rooms": list(self.rooms.keys()), "count": len(self.rooms),
+                "bytes": self.used_bytes}, 200
+
+    def ping(self):
+        """Keep-alive endpoint."""
+        return {"status": "alive", "timestamp": time.time()}, 200
+
+    def metrics_text(self):
+        """Prometheus text for GET /metrics: the counters plus the relay's current state."""
+        with self.lock:
+            depths = [len(r["commands"]) + len(r["unparsed"] or ()) for r in self.rooms.values()]
+            members = sum(len(r["members"]) for r in self.rooms.values())
+            gauges = {
+                "relay_rooms": len(self.rooms),
+                "relay_members": members,
+                "relay_queued_commands": sum(depths),
+                "relay_room_queue_depth_max": max(depths, default=0),
+                "relay_stored_bytes": self.used_bytes,
+            }
+        if self.store is not None:
+            gauges["relay_store_backlog"] = self.store.events.qsize()
+        return self.metrics.render(gauges), 200
+
+    def cleanup_old_rooms(self):
+        if not self.rooms:
+            return
+        current_time = time.time()
+        with self.lock:
+            # A room lives while anyone is still polling it, whoever hosted it
+            to_delete = [
+                room_code for room_code, room_data in self.rooms.items()
+                if current_time - max([room_data.get("created_at", 0), room_data.get("restored_at", 0)] +
+                                      [m["last_seen"] for m in room_data["members"].values()]) > self.room_timeout
+            ]
+            for room_code in to_delete:
+                self.used_bytes -= self.rooms.pop(room_code)["bytes"]
+                if self.store is not None:
+                    self.store.room_deleted(room_code)
+        if to_delete:
+            self.metrics.inc("relay_rooms_expired_total", amount=len(to_delete))
+        for room_code in to_delete:
+            log_event(logging.INFO, "room_expired", room=room_code)
+
+    # ----- commands -----
+
+    def send(self, room_code, data):
+        room = self._room(room_code)
+        if room is None:
+            return {"error": "Room not found"}, 404
+
+        try:
+            cmd_data = build_command(data)
+        except ValueError:
+            return {"error": "Bad request"}, 400
+        command = cmd_data["command"]
+        extra_data = cmd_data.get("data")
+        size = len(json.dumps(cmd_data))
+        if size > self.max_command_size:
+            self.metrics.inc("relay_rejected_total", ("too_large",))
+            return {"error": "Command too large", "max_size": self.max_command_size}, 413
+
+        # Every member reads from the same log (see receive), so keep
+        # commands around until the slowest member has them
+        with self.lock:
+            now = time.time()
+            if "id" in cmd_data:
+                # A client retrying a command we already stored (its reply got lost)
+                seq = room["recent_ids"].get(cmd_data["id"])
+                if seq is not None:
+                    self.metrics.inc("relay_rejected_total", ("duplicate",))
+                    return {"status": "duplicate", "seq": seq}, 200
+            wait = self.send_limiter.acquire((room_code, cmd_data.get("origin")), now)
+            if wait:
+                self.metrics.inc("relay_rejected_total", ("rate_limited",))
+                return rate_limited(wait)
+            self._compact(room, cmd_data)
+            self._append(room, cmd_data, now, size)
+            self._prune_commands(room, now)
+            self._enforce_budgets(room)
+        self.metrics.inc("relay_commands_total", (command,))
+        self.metrics.observe("relay_command_bytes", size)
+        log_event(logging.DEBUG, "command_stored", room=room_code, command=command, data=extra_data is not None)
+        return {"status": "ok", "seq": cmd_data["seq"]}, 200
+
+    def _append(self, room, cmd_data, now, size=None):
+        room["seq"] += 1
+        cmd_data["seq"] = room["seq"]
+        if "id" in cmd_data:
+            room["recent_ids"].add(cmd_data["id"], room["seq"])
+        cmd_data["timestamp"] = now
+        room["commands"].append(cmd_data)
+        size = len(json.dumps(cmd_data)) if size is None else size
+        room["sizes"][cmd_data["seq"]] = size
+        self._account(room, size)
+        if self.store is not None:
+            self.store.command_added(room["code"], room, cmd_data)
+
+    def receive(self, room_code, since=0.0, client=None, after=None):
+        """Commands newer than sequence number `after` (or server time `since`)."""
+        room = self._room(room_code)
+        if room is None:
+            return {"error": "Room not found"}, 404
+
+        # Each client passes the cursor of its last poll and only gets newer
+        # commands, so every member of the room sees every command
+        with self.lock:
+            now = time.time()
+            gap = False
+            if after is not None and after > room["seq"]:
+                # A cursor from before a relay restart: replay the recreated room's whole log
+                gap, after = True, 0
+            if client:
+                # Polls double as presence heartbeats (no separate /ping needed),
+                # and `after` tells us how far this member has read
+                self._touch_member(room, client, after, now)
+                self._prune_commands(room, now)
+            commands = room["commands"]
+            if after is not None:
+                gap = gap or after < room["floor"]  # missed commands already pruned
+                cmds = [c for c in commands if c["seq"] > after]
+            else:
+                cmds = [c for c in commands if since < c["timestamp"] <= now]
+            if client:
+                # Don't echo a client's own commands back to it, and skip
+                # commands addressed to other members
+                cmds = [c for c in cmds if c.get("origin") != client
+                        and ("to" not in c or client in c["to"])]
+
+        if cmds:
+            self.metrics.inc("relay_commands_delivered_total", amount=len(cmds))
+            log_event(logging.DEBUG, "commands_delivered", room=room_code, count=len(cmds))
+
+        return {"commands": cmds, "epoch": room["epoch"], "seq": room["seq"], "gap": gap,
+                "host": room.get("host"), "timestamp": now}, 200
+
+    # ----- blobs -----
+
+    def put_blob(self, room_code, key, data):
+        """Store a track chunk uploaded by the client that owns the track."""
+        room = self._room(room_code)
+        if room is None:
+            return {"error": "Room not found"}, 404
+        if len(data) > self.max_blob_size:
+            self.metrics.inc("relay_rejected_total", ("blob_too_large",))
+            return {"error": "Blob too large"}, 413
+
+        with self.lock:
+            now = time.time()
+            wait = self.blob_limiter.acquire(room_code, now)
+            if wait:
+                self.metrics.inc("relay_rejected_total", ("blob_rate_limited",))
+                return rate_limited(wait)
+            blobs = room["blobs"]
+            for old_key in [k for k, (_, stored_at) in blobs.items() if now - stored_at > self.blob_ttl]:
+                self._account_blob(room, -len(blobs.pop(old_key)[0]))
+            if key in blobs:
+                self._account_blob(room, -len(blobs[key][0]))
+            blobs[key] = (data, now)
+            self._account_blob(room, len(data))
+            self._enforce_budgets(room)
+        self.metrics.observe("relay_blob_bytes", len(data))
+        return {"status": "ok"}, 200
+
+    def get_blob(self, room_code, key):
+        """Fetch a track chunk (404 until the owner has uploaded it)."""
+        room = self._room(room_code)
+        if room is None:
+            return {"error": "Room not found"}, 404
+        blob = room["blobs"].get(key)
+        if blob is None:
+            return {"error": "Blob not found"}, 404
+        return blob[0], 200
+
+
+# ---------------------------------------
+# EMBEDDED HTTP SERVER (no Flask)
+# ---------------------------------------
+
+def max_request_size(core):
+    """Largest request body worth reading."""
+    return max(core.max_blob_size, core.max_command_size) + 64 * 1024
+
+
+ROUTES = {"host", "join", "send", "receive", "blob", "members", "ping", "rooms", "ring", "metrics"}
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def redirect_location(payload, status, path):
+    """Location header for a sharded relay's redirect to the room's node (see relay_ring.py)."""
+    if status == 307 and isinstance(payload, dict) and "node" in payload:
+        return payload["node"].rstrip("/") + path
+    return None
+
+
+def _make_handler(core):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # headers and body are separate writes: don't stall keep-alive replies
+
+        def _route(self, method):
+            url = urlparse(self.path)
+            parts = [p for p in url.path.split("/") if p]
+            query = parse_qs(url.query)
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > max_request_size(core):
+                self.close_connection = True  # don't read it
+                return {"error": "Request too large"}, 413
+            body = self.rfile.read(length) if length else b""
+
+            core.cleanup_old_rooms()
+
+            try:
+                route = (method, parts[0] if parts else "", len(parts))
+                if route == ("POST", "host", 1):
+                    request = json_object(body)
+                    return core.host(request.get("room_code"), request.get("client"))
+                if route == ("POST", "join", 2):
+                    return core.join(parts[1], json_object(body).get("client"))
+                if route == ("POST", "send", 2):
+                    return core.send(parts[1], json.loads(body or b"{}"))
+                if route == ("GET", "receive", 2):
+                    after = query.get("after", [None])[0]
+                    return core.receive(parts[1], float(query.get("since", ["0"])[0]),
+                                        query.get("client", [None])[0],
+                                        int(after) if after is not None else None)
+                if route == ("PUT", "blob", 3):
+                    return core.put_blob(parts[1], parts[2], body)
+                if route == ("GET", "blob", 3):
+                    return core.get_blob(parts[1], parts[2])
+                if route == ("GET", "members", 2):
+                    return core.members(parts[1])
+                if route == ("GET", "ping", 1):
+                    return core.ping()
+                if route == ("GET", "rooms", 1):
+                    return core.list_rooms()
+                if route == ("GET", "metrics", 1):
+                    return core.metrics_text()
+                if route == ("GET", "ring", 1) and hasattr(core, "ring_info"):
+                    return core.ring_info()
+                if route == ("POST", "ring", 1) and hasattr(core, "set_ring"):
+                    return core.set_ring(json_object(body))
+            except (ValueError, TypeError):  # malformed body, e.g. a room code that isn't a string
+                return {"error": "Bad request"}, 400
+            return {"error": "Not found"}, 404
+
+        def _reply(self, method):
+            start = time.perf_counter()
+            route = urlparse(self.path).path.split("/")[1]
+            route = route if route in ROUTES else "other"
+            if route == "receive":
+                core.metrics.inc("relay_poll_waiters")
+            try:
+                payload, status = self._route(method)
+            finally:
+                if route == "receive":
+                    core.metrics.inc("relay_poll_waiters", amount=-1)
+            if isinstance(payload, bytes):
+                body, content_type = payload, "application/octet-stream"
+            elif isinstance(payload, str):
+                body, content_type = payload.encode("utf-8"), METRICS_CONTENT_TYPE
+            else:
+                body, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+            core.metrics.inc("relay_requests_total", (route, status))
+            core.metrics.observe("relay_request_seconds", time.perf_counter() - start, (route,))
+            self.send_response(status)
+            location = redirect_location(payload, status, self.path)
+            if location:
+                self.send_header("Location", location)
+            if isinstance(payload, dict) and "retry_after" in payload:
+                self.send_header("Retry-After", str(math.ceil(payload["retry_after"])))
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._reply("GET")
+
+        def do_POST(self):
+            self._reply("POST")
+
+        def do_PUT(self):
+            self._reply("PUT")
+
+        def log_message(self, *args):
+            pass  # the core already prints what matters
+
+    return Handler
+
+
+class _ReusePortHTTPServer(ThreadingHTTPServer):
+    """Lets several worker processes accept on the same port (Linux/BSD)."""
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class EmbeddedRelay:
+    """A RelayCore (or anything with its methods) served over HTTP from a background thread."""
+
+    def __init__(self, core=None, host="0.0.0.0", port=0, reuse_port=False):
+        self.core = core or RelayCore()
+        server_class = _ReusePortHTTPServer if reuse_port else ThreadingHTTPServer
+        self.httpd = server_class((host, port), _make_handler(self.core))
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def serve_in_background(core=None, host="0.0.0.0", port=0):
+    """Start a relay on a background thread; returns the running EmbeddedRelay."""
+    return EmbeddedRelay(core, host, port).start()
+
+
+if __name__ == "__main__":
+    import argparse
+    import signal
+
+    parser = argparse.ArgumentParser(description="Self-hosted Music Sync relay (no Flask needed)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--db", help="SQLite file to keep rooms in across restarts")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port (needs --shared-db when > 1)")
+    parser.add_argument("--shared-db", help="SQLite file holding rooms for all workers")
+    parser.add_argument("--node", help="this relay's public URL, when sharding rooms over --ring")
+    parser.add_argument("--ring", help="comma-separated URLs of every relay node (including --node)")
+    parser.add_argument("--ring-token", help="secret that allows POST /ring to change the node list")
+    parser.add_argument("--log-level", default="INFO", help="DEBUG logs (sampled) per-command events too")
+    parser.add_argument("--log-json", action="store_true", help="log JSON lines instead of key=value")
+    args = parser.parse_args()
+    if bool(args.node) != bool(args.ring):
+        parser.error("--node and --ring go together")
+    if args.ring and args.shared_db:
+        parser.error("--ring runs one process per node (POST /ring would only reach one worker)")
+
+    from relay_log import setup_logging
+    setup_logging(args.log_level, args.log_json)
+
+    if args.shared_db:
+        from relay_shared import serve_workers
+        processes = serve_workers(args.shared_db, args.workers, args.host, args.port)
+        log_event(logging.INFO, "relay_listening", host=args.host, port=args.port, workers=args.workers)
+
+        def stop_workers(signum, frame):
+            # SIGTERM skips atexit, which is what stops daemon processes otherwise
+            for process in processes:
+                process.terminate()
+            raise SystemExit
+
+        signal.signal(signal.SIGTERM, stop_workers)
+        for process in processes:
+            process.join()
+        raise SystemExit
+    if args.workers > 1:
+        parser.error("--workers needs --shared-db so the workers see the same rooms")
+
+    core = None
+    if args.db:
+        from relay_store import SqliteStore
+        core = RelayCore(store=SqliteStore(args.db))
+    if args.ring:
+        from relay_ring import ShardedCore
+        core = ShardedCore(core or RelayCore(), args.node, args.ring.split(","), args.ring_token)
+    relay = EmbeddedRelay(core, host=args.host, port=args.port)
+    log_event(logging.INFO, "relay_listening", host=args.host, port=relay.port)
+    relay.httpd.serve_forever()
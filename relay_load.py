@@ -0,0 +1,325 @@
+"""
+Load generator and latency benchmark for the relay.
+
+Simulates rooms full of members over the real HTTP API: every member
+polls /receive with its cursor like the client does, and one member per
+room at a time sends commands at the configured rate. Each command carries
+its send time, so the receiving members measure delivery latency (send to
+receive, which includes the poll interval). The relay has no long-poll, so
+polling is all there is.
+
+By default a relay (relay_core.py) is started on a free local port and its
+memory (RSS, including worker processes) is sampled while the load runs;
+--target points the load at a relay that is already running instead.
+
+    python relay_load.py --rooms 50 --members 4 --rate 2 --payload 512 --duration 20
+    python relay_load.py --relay-args "--workers 4 --shared-db /tmp/rooms.db"
+    python relay_load.py --target http://127.0.0.1:8080 --json results.json
+
+Results go to stdout (and --json, to compare releases).
+"""
+
+import argparse
+import heapq
+import http.client
+import json
+import multiprocessing
+import os
+import queue
+import random
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from urllib.parse import urlparse
+
+from relay_client import POLL_JITTER
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Member:
+    def __init__(self, base, code, client, seq):
+        url = urlparse(base)
+        self.conn = http.client.HTTPConnection(url.hostname, url.port, timeout=10)
+        self.code = code
+        self.client = client
+        self.seq = seq
+
+    def request(self, method, path, body=None):
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        try:
+            self.conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+            response = self.conn.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()  # reconnects on the next request
+            return None, b""
+
+
+def run_rooms(base, rooms, members, rate, payload, poll_interval, duration, results):
+    """One load process: host `rooms` rooms and drive their members until `duration` is up."""
+    pad = "x" * payload
+    stats = {"sends": 0, "polls": 0, "delivered": 0, "errors": {}, "latency": [],
+             "send_ms": [], "poll_ms": [], "behind": 0.0}
+
+    def note(kind, status, started):
+        if status != 200:
+            stats["errors"][str(status)] = stats["errors"].get(str(status), 0) + 1
+        stats[kind].append((time.perf_counter() - started) * 1000)
+
+    room_members = []
+    for _ in range(rooms):
+        host = Member(base, None, uuid.uuid4().hex[:8], 0)
+        status, body = host.request("POST", "/host", {"client": host.client})
+        if status != 200:
+            stats["errors"][f"host {status}"] = stats["errors"].get(f"host {status}", 0) + 1
+            continue
+        reply = json.loads(body)
+        host.code = reply["room_code"]
+        group = [host]
+        for _ in range(members - 1):
+            member = Member(base, host.code, uuid.uuid4().hex[:8], 0)
+            status, body = member.request("POST", f"/join/{host.code}", {"client": member.client})
+            if status == 200:
+                member.seq = json.loads(body)["seq"]
+                group.append(member)
+        room_members.append(group)
+
+    start = time.time()
+    end = start + duration
+    schedule = []  # (due, order, kind, room index, member index)
+    order = 0
+    for r, group in enumerate(room_members):
+        for m in range(len(group)):
+            # Random phases, like clients that joined at different times
+            schedule.append((start + random.uniform(0, poll_interval), order, "poll", r, m))
+            order += 1
+        if rate > 0:
+            schedule.append((start + random.expovariate(rate), order, "send", r, 0))
+            order += 1
+    heapq.heapify(schedule)
+
+    while schedule:
+        due, _, kind, r, m = heapq.heappop(schedule)
+        if due >= end:
+            continue
+        now = time.time()
+        if due > now:
+            time.sleep(due - now)
+        else:
+            stats["behind"] = max(stats["behind"], now - due)
+        group = room_members[r]
+        member = group[m]
+        started = time.perf_counter()
+        if kind == "send":
+            status, _ = member.request("POST", f"/send/{member.code}", {
+                "command": "queue_ops", "id": uuid.uuid4().hex[:16], "origin": member.client,
+                "data": {"sent_at": time.time(), "pad": pad}})
+            note("send_ms", status, started)
+            stats["sends"] += 1
+            # Poisson arrivals; the next command comes from the next member, like a room taking turns
+            heapq.heappush(schedule, (due + random.expovariate(rate), order, "send", r, (m + 1) % len(group)))
+        else:
+            status, body = member.request("GET", f"/receive/{member.code}?after={member.seq}&client={member.client}")
+            note("poll_ms", status, started)
+            stats["polls"] += 1
+            if status == 200:
+                reply = json.loads(body)
+                received = time.time()
+                for cmd in reply["commands"]:
+                    sent_at = (cmd.get("data") or {}).get("sent_at")
+                    if sent_at:
+                        stats["latency"].append((received - sent_at) * 1000)
+                stats["delivered"] += len(reply["commands"])
+                member.seq = reply["seq"]
+            delay = poll_interval * (1 + POLL_JITTER * random.uniform(-1, 1))  # as PollScheduler jitters
+            heapq.heappush(schedule, (due + delay, order, "poll", r, m))
+        order += 1
+    results.put(stats)
+
+
+# ---------------------------------------
+# SERVER
+# ---------------------------------------
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_relay(relay_args):
+    port = free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    # Its own process group, so stop_relay() also reaches the relay's --workers processes
+    process = subprocess.Popen([sys.executable, os.path.join(here, "relay_core.py"), "--host", "127.0.0.1",
+                                "--port", str(port), "--log-level", "WARNING", *shlex.split(relay_args)],
+                               start_new_session=True)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.05)
+    stop_relay(process)
+    raise RuntimeError("relay did not start")
+
+
+def stop_relay(process):
+    """Stop the relay and every worker it started."""
+    for sig, wait in ((signal.SIGTERM, 5), (signal.SIGKILL, None)):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            process.wait(wait)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def rss_kb(pid):
+    """Resident memory of pid and its child processes (Linux /proc), in kB."""
+    total = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            if int(entry) != pid and ppid != pid:
+                continue
+            with open(f"/proc/{entry}/status") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        except (OSError, StopIteration, ValueError, IndexError):
+            continue
+    return total
+
+
+# ---------------------------------------
+# MAIN
+# ---------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay load generator and latency benchmark")
+    parser.add_argument("--target", help="URL of a running relay (default: start one locally)")
+    parser.add_argument("--relay-args", default="", help="extra relay_core.py arguments for the local relay")
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--members", type=int, default=4, help="members per room, including the host")
+    parser.add_argument("--rate", type=float, default=2.0, help="commands per second per room")
+    parser.add_argument("--payload", type=int, default=256, help="padding bytes per command")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="seconds between a member's polls")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--procs", type=int, default=max(1, min(4, os.cpu_count() or 1)),
+                        help="load generator processes")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    server = None
+    base = args.target
+    if base is None:
+        server, base = start_relay(args.relay_args)
+    try:
+        results = multiprocessing.Queue()
+        shares = [args.rooms // args.procs + (i < args.rooms % args.procs) for i in range(args.procs)]
+        workers = [multiprocessing.Process(target=run_rooms, args=(
+            base, share, args.members, args.rate, args.payload, args.poll_interval, args.duration, results))
+            for share in shares if share]
+        for worker in workers:
+            worker.start()
+        memory = []
+        deadline = time.time() + args.duration + 60  # setup of many rooms can take a while
+        while any(w.is_alive() for w in workers) and results.qsize() < len(workers) and time.time() < deadline:
+            if server is not None:
+                memory.append(rss_kb(server.pid))
+            time.sleep(0.25)
+        # A load process that crashed never reports, don't wait for it forever
+        parts = []
+        while len(parts) < len(workers) and time.time() < deadline:
+            try:
+                parts.append(results.get(timeout=1))
+            except queue.Empty:
+                if not any(w.is_alive() for w in workers):
+                    break
+        for worker in workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+    finally:
+        if server is not None:
+            stop_relay(server)
+
+    crashed = [w.exitcode for w in workers if w.exitcode != 0]
+    if crashed:
+        print(f"⚠️ {len(crashed)} of {len(workers)} load process(es) failed (exit codes {crashed}), "
+              f"results cover the other {len(parts)}")
+    if not parts:
+        raise SystemExit("no load process finished, nothing to report")
+
+    latency = [x for p in parts for x in p["latency"]]
+    send_ms = [x for p in parts for x in p["send_ms"]]
+    poll_ms = [x for p in parts for x in p["poll_ms"]]
+    errors = {}
+    for p in parts:
+        for status, count in p["errors"].items():
+            errors[status] = errors.get(status, 0) + count
+    requests = sum(p["sends"] + p["polls"] for p in parts)
+    summary = {
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+        "failed_generators": len(crashed),
+        "requests_per_s": round(requests / args.duration, 1),
+        "sends_per_s": round(sum(p["sends"] for p in parts) / args.duration, 1),
+        "deliveries_per_s": round(sum(p["delivered"] for p in parts) / args.duration, 1),
+        "error_rate": round(sum(errors.values()) / max(requests, 1), 5),
+        "errors": errors,
+        "delivery_ms": {q: _round(percentile(latency, v)) for q, v in (("p50", .5), ("p99", .99), ("p999", .999))},
+        "send_ms": {q: _round(percentile(send_ms, v)) for q, v in (("p50", .5), ("p99", .99))},
+        "poll_ms": {q: _round(percentile(poll_ms, v)) for q, v in (("p50", .5), ("p99", .99))},
+        "generator_behind_s": round(max(p["behind"] for p in parts), 3),
+        "server_rss_mb": {"start": _mb(memory[0]), "peak": _mb(max(memory)), "end": _mb(memory[-1])}
+        if memory else None,
+    }
+
+    print(f"{args.rooms} rooms x {args.members} members, {args.rate} cmd/s/room, "
+          f"{args.payload} B payload, {args.duration:.0f} s against {base}")
+    print(f"throughput: {summary['requests_per_s']} req/s ({summary['sends_per_s']} sends/s, "
+          f"{summary['deliveries_per_s']} deliveries/s)")
+    d = summary["delivery_ms"]
+    print(f"delivery latency: p50 {d['p50']} ms, p99 {d['p99']} ms, p999 {d['p999']} ms "
+          f"(includes the {args.poll_interval} s poll interval)")
+    print(f"request latency: send p50/p99 {summary['send_ms']['p50']}/{summary['send_ms']['p99']} ms, "
+          f"poll p50/p99 {summary['poll_ms']['p50']}/{summary['poll_ms']['p99']} ms")
+    print(f"errors: {summary['error_rate']:.3%} {errors or ''}")
+    if summary["server_rss_mb"]:
+        m = summary["server_rss_mb"]
+        print(f"server memory: {m['start']} MB at start, {m['peak']} MB peak, {m['end']} MB at end")
+    if summary["generator_behind_s"] > args.poll_interval:
+        print(f"⚠️ the load generator fell {summary['generator_behind_s']} s behind schedule, "
+              f"add --procs or lower the load")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+def _round(value):
+    return round(value, 2) if value is not None else None
+
+
+def _mb(kb):
+    return round(kb / 1024, 1)
+
+
+if __name__ == "__main__":
+    main()
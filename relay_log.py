@@ -0,0 +1,152 @@
+"""
+Structured, non-blocking logging for the relay.
+
+Relay code logs events, not sentences:
+
+    log_event(logging.DEBUG, "command_stored", room=room_code, command=command)
+
+An event whose level is disabled costs one isEnabledFor() check. Events in
+SAMPLE_RATES (the per-request ones) are logged once every N occurrences,
+with sampled=N on the line. Records go onto a queue; a listener thread
+formats them (key=value or JSON lines) and writes them out, so a slow
+stdout or log pipe never holds up a request.
+
+Nothing is printed until setup_logging() is called (the servers' entry
+points do), except warnings and errors, which fall back to stderr.
+
+Run this file directly for the per-event cost benchmark.
+"""
+
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+log = logging.getLogger("relay")
+
+SAMPLE_RATES = {            # event -> log 1 in N
+    "command_stored": 100,
+    "commands_delivered": 100,
+}
+
+_counters = {event: itertools.count() for event in SAMPLE_RATES}
+_listener = None
+_handlers = []
+
+
+def log_event(level, event, **fields):
+    """Log `event` with structured fields (sampled for high-frequency events)."""
+    if not log.isEnabledFor(level):
+        return
+    rate = SAMPLE_RATES.get(event)
+    if rate:
+        if next(_counters[event]) % rate:
+            return
+        fields["sampled"] = rate
+    log.log(level, event, extra={"fields": fields})
+
+
+class StructuredFormatter(logging.Formatter):
+    """One line per event: `ts level event key=value ...`, or a JSON object."""
+
+    def __init__(self, json_lines=False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        if self.json_lines:
+            return json.dumps(entry, default=str)
+        head = f"{entry.pop('ts')} {entry.pop('level'):<7} {entry.pop('event')}"
+        return " ".join([head] + [f"{k}={_value(v)}" for k, v in entry.items()])
+
+
+def _value(v):
+    text = str(v)
+    return json.dumps(text) if not text or any(c in text for c in ' "=\n') else text
+
+
+class _RecordQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record  # formatting happens on the listener thread, not the request's
+
+
+def setup_logging(level="INFO", json_lines=False, stream=None):
+    """Send relay logs through a queue to `stream` (stderr by default)."""
+    global _listener, _handlers
+    stop_logging()
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(StructuredFormatter(json_lines))
+    _handlers = [handler]
+    log.setLevel(level.upper() if isinstance(level, str) else level)
+    log.propagate = False
+    _start_listener()
+    atexit.register(stop_logging)
+
+
+def _start_listener():
+    global _listener
+    records = queue.SimpleQueue()
+    for old in [h for h in log.handlers if isinstance(h, _RecordQueueHandler)]:
+        log.removeHandler(old)
+    log.addHandler(_RecordQueueHandler(records))
+    _listener = logging.handlers.QueueListener(records, *_handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Flush what is queued and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _after_fork():
+    # The listener thread doesn't survive fork: worker processes get their own
+    if _listener is not None:
+        _start_listener()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+if __name__ == "__main__":
+    import io
+
+    N = 100000
+    out = io.StringIO()
+    setup_logging("INFO", stream=out)
+
+    start = time.perf_counter()
+    for i in range(N):
+        log_event(logging.DEBUG, "command_stored", room="ABC123", command="play")
+    disabled = time.perf_counter() - start
+
+    log.setLevel(logging.DEBUG)
+    start = time.perf_counter()
+    for i in range(N):
+        log_event(logging.DEBUG, "command_stored", room="ABC123", command="play")
+    sampled = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(N):
+        log_event(logging.INFO, "member_left", room="ABC123", client=f"c{i}")
+    queued = time.perf_counter() - start
+    stop_logging()
+
+    print(f"per event: disabled {disabled / N * 1e9:.0f} ns, sampled 1/100 {sampled / N * 1e9:.0f} ns, "
+          f"every event queued {queued / N * 1e6:.1f} us")
+    print(out.getvalue().splitlines()[0])
@@ -0,0 +1,198 @@
+"""
+Sharding rooms across several relay nodes by consistent hashing.
+
+Every node and client that knows the node list computes the same owner for
+a room code (HashRing.node_for), so there is no directory to keep in sync.
+ShardedCore wraps a RelayCore (or SharedRelayCore) on one node:
+
+- /host only hands out room codes this node owns,
+- any other request for a room owned elsewhere gets a 307 redirect to the
+  owner (payload {"error", "node"} plus a Location header),
+- GET /ring returns the node list, for clients to route joins directly,
+- POST /ring {"nodes": [...], "token": ...} changes it (admin only).
+
+Adding or removing a node moves only the rooms whose arc of the ring
+changed hands (about 1/N of them). Their members get redirected on their
+next poll, find no room on the new owner, and reopen it there from their
+own replica of the queue, the same path they use after a relay restart.
+The old node lets the abandoned copy expire.
+
+Run this file directly to start three local relay processes and watch a
+rebalance.
+"""
+
+import bisect
+import hashlib
+import hmac
+import logging
+import time
+import uuid
+
+from relay_log import log_event
+
+RING_REPLICAS = 64  # points per node on the ring; more = more even split
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes=(), replicas=RING_REPLICAS):
+        self.replicas = replicas
+        self.nodes = []
+        self._points = []  # sorted (hash, node)
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for i in range(self.replicas):
+            bisect.insort(self._points, (_hash(f"{node}#{i}"), node))
+
+    def remove(self, node):
+        if node in self.nodes:
+            self.nodes.remove(node)
+            self._points = [p for p in self._points if p[1] != node]
+
+    def node_for(self, room_code):
+        """The node that owns room_code (None if the ring is empty)."""
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, (_hash(room_code.upper()),))
+        return self._points[i % len(self._points)][1]
+
+
+class ShardedCore:
+    """A relay core that only serves the rooms its node owns on the ring."""
+
+    def __init__(self, core, node, nodes, admin_token=None):
+        self.core = core
+        self.node = node
+        self.ring = HashRing(nodes)
+        self.admin_token = admin_token
+
+    def __getattr__(self, name):
+        # ping, list_rooms, cleanup_old_rooms, rooms, ... are per node
+        return getattr(self.core, name)
+
+    def _elsewhere(self, room_code):
+        owner = self.ring.node_for(room_code)
+        if owner is not None and owner != self.node:
+            return {"error": "Room lives on another node", "node": owner}, 307
+        return None
+
+    def host(self, room_code=None, client=None):
+        if room_code is not None:
+            return self._elsewhere(room_code) or self.core.host(room_code, client)
+        if self.node not in self.ring.nodes:
+            # Taken off the ring: new rooms belong to the nodes still on it
+            return self._elsewhere(str(uuid.uuid4())[:6].upper())
+        # Draw codes until one lands on our arc (1 in N on average)
+        while True:
+            room_code = str(uuid.uuid4())[:6].upper()
+            if self._elsewhere(room_code) is None:
+                result = self.core.host(room_code, client)
+                if result[1] != 409:
+                    return result
+
+    def join(self, room_code, client=None):
+        return self._elsewhere(room_code) or self.core.join(room_code, client)
+
+    def send(self, room_code, data):
+        return self._elsewhere(room_code) or self.core.send(room_code, data)
+
+    def receive(self, room_code, since=0.0, client=None, after=None):
+        return self._elsewhere(room_code) or self.core.receive(room_code, since, client, after)
+
+    def members(self, room_code):
+        return self._elsewhere(room_code) or self.core.members(room_code)
+
+    def put_blob(self, room_code, key, data):
+        return self._elsewhere(room_code) or self.core.put_blob(room_code, key, data)
+
+    def get_blob(self, room_code, key):
+        return self._elsewhere(room_code) or self.core.get_blob(room_code, key)
+
+    def ring_info(self):
+        return {"nodes": list(self.ring.nodes), "node": self.node}, 200
+
+    def set_ring(self, data):
+        """Replace the node list (every node must be given the same one)."""
+        data = data if isinstance(data, dict) else {}
+        if not self.admin_token or not hmac.compare_digest(str(data.get("token", "")), self.admin_token):
+            return {"error": "Forbidden"}, 403
+        nodes = data.get("nodes")
+        if not nodes or not isinstance(nodes, list) or not all(isinstance(n, str) for n in nodes):
+            return {"error": "Bad request"}, 400
+        self.ring = HashRing(nodes)
+        log_event(logging.INFO, "ring_updated", nodes=",".join(nodes))
+        return self.ring_info()
+
+
+if __name__ == "__main__":
+    import json
+    import multiprocessing
+    import socket
+    import urllib.error
+    import urllib.request
+
+    from relay_core import EmbeddedRelay, RelayCore
+
+    TOKEN = "demo"
+
+    def serve(port, nodes):
+        core = ShardedCore(RelayCore(), f"http://127.0.0.1:{port}", nodes, TOKEN)
+        EmbeddedRelay(core, "127.0.0.1", port).httpd.serve_forever()
+
+    def call(method, url, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(url, data, {"Content-Type": "application/json"}, method=method)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read()), response.url
+        except urllib.error.HTTPError as e:
+            if e.code == 307:
+                return call(method, e.headers["Location"], body)  # requests follows these itself
+            return e.code, json.loads(e.read()), e.url
+
+    def free_port():
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    # Moved fraction when a fourth node joins a ring of three
+    codes = [str(uuid.uuid4())[:6].upper() for _ in range(20000)]
+    three = HashRing(["a", "b", "c"])
+    four = HashRing(["a", "b", "c", "d"])
+    moved = sum(three.node_for(c) != four.node_for(c) for c in codes) / len(codes)
+    share = {n: sum(four.node_for(c) == n for c in codes) / len(codes) for n in four.nodes}
+    print(f"adding a 4th node moves {moved:.1%} of rooms (ideal 25%), "
+          f"split {', '.join(f'{n}={s:.0%}' for n, s in share.items())}")
+
+    ports = [free_port() for _ in range(3)]
+    nodes = [f"http://127.0.0.1:{p}" for p in ports]
+    processes = [multiprocessing.Process(target=serve, args=(p, nodes[:2]), daemon=True) for p in ports]
+    for process in processes:
+        process.start()
+    time.sleep(0.5)
+
+    # Host through the first node, join through the second: the redirect finds the owner
+    codes = [call("POST", f"{nodes[0]}/host", {"client": "alice"})[1]["room_code"] for _ in range(12)]
+    status, _, url = call("POST", f"{nodes[1]}/join/{codes[0]}", {"client": "bob"})
+    print(f"room {codes[0]} joined via {nodes[1]} -> {status} at {url}")
+
+    # Grow the ring to three nodes; moved rooms are reopened on their new owner by their members
+    for node in nodes:
+        call("POST", f"{node}/ring", {"nodes": nodes, "token": TOKEN})
+    moved = reopened = 0
+    for code in codes:
+        status, _, url = call("GET", f"{nodes[0]}/receive/{code}?after=0&client=alice")
+        if status == 404:
+            moved += 1
+            reopened += call("POST", f"{nodes[0]}/host", {"room_code": code, "client": "alice"})[0] == 200
+    print(f"after adding a 3rd node: {moved}/{len(codes)} rooms moved, {reopened} reopened on the new node")
+    for process in processes:
+        process.terminate()
@@ -1,101 +1,171 @@
-from flask import Flask, request, jsonify
-import uuid
+from flask import Flask, Response, g, request, jsonify
+
+import logging
+import math
+import os
 import time
 
-app = Flask(__name__)
-rooms = {}
+from relay_core import METRICS_CONTENT_TYPE, ROUTES, RelayCore, max_request_size, redirect_location
+from relay_log import setup_logging
+from relay_ring import ShardedCore
+from relay_shared import SharedRelayCore
+from relay_store import SqliteStore
+
+# Development only: Flask debug mode (reloader, debugger) and per-request logs
+RELAY_DEBUG = os.environ.get("RELAY_DEBUG") == "1"
+RELAY_LOG_LEVEL = os.environ.get("RELAY_LOG_LEVEL", "DEBUG" if RELAY_DEBUG else "INFO")
+RELAY_LOG_JSON = os.environ.get("RELAY_LOG_FORMAT") == "json"
+RELAY_DB = os.environ.get("RELAY_DB")  # SQLite file for rooms to survive restarts (unset: memory only)
+# SQLite file shared by several workers, e.g. gunicorn -w 4 -b 0.0.0.0:8080 relay_server:app
+RELAY_SHARED_DB = os.environ.get("RELAY_SHARED_DB")
+# Sharding rooms over several relays: this node's public URL and every node's, comma-separated.
+# POST /ring (with RELAY_RING_TOKEN) only updates the worker that receives it, so with
+# several workers change RELAY_RING and restart instead.
+RELAY_NODE = os.environ.get("RELAY_NODE")
+RELAY_RING = os.environ.get("RELAY_RING")
+
+setup_logging(RELAY_LOG_LEVEL, RELAY_LOG_JSON)
+if not RELAY_DEBUG:
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no synchronous access log line per request
 
-# Clean up old rooms periodically (optional but recommended)
-ROOM_TIMEOUT = 3600  # 1 hour
+app = Flask(__name__)
+if RELAY_SHARED_DB:
+    core = SharedRelayCore(RELAY_SHARED_DB)
+else:
+    core = RelayCore(store=SqliteStore(RELAY_DB) if RELAY_DB else None)
+if RELAY_NODE and RELAY_RING:
+    core = ShardedCore(core, RELAY_NODE, RELAY_RING.split(","), os.environ.get("RELAY_RING_TOKEN"))
+app.config["MAX_CONTENT_LENGTH"] = max_request_size(core)  # Flask answers 413 beyond this
+
+
+def reply(result):
+    """Turn a RelayCore (payload, status) result into a Flask response."""
+    payload, status = result
+    if isinstance(payload, bytes):
+        return Response(payload, mimetype="application/octet-stream"), status
+    if isinstance(payload, str):
+        return Response(payload, content_type=METRICS_CONTENT_TYPE), status
+    response = jsonify(payload)
+    location = redirect_location(payload, status, request.full_path.rstrip("?"))
+    if location:
+        response.headers["Location"] = location
+    if "retry_after" in payload:
+        response.headers["Retry-After"] = str(math.ceil(payload["retry_after"]))
+    return response, status
+
+
+def json_object(*string_fields):
+    """The request's JSON body ({} if there is none), or None if it isn't an
+    object or one of string_fields holds something other than a string."""
+    body = request.get_json(silent=True)
+    if body is None:
+        return {}
+    if not isinstance(body, dict) or any(not isinstance(body.get(k), (str, type(None))) for k in string_fields):
+        return None
+    return body
 
 
 @app.route("/host", methods=["POST"])
 def host_session():
-    room_code = str(uuid.uuid4())[:6].upper()  # 6-character room code
-    rooms[room_code] = {
-        "commands": [],
-        "created_at": time.time()
-    }
-    return jsonify({"room_code": room_code})
+    body = json_object("room_code", "client")
+    if body is None:
+        return reply(({"error": "Bad request"}, 400))
+    return reply(core.host(body.get("room_code"), body.get("client")))
 
 
 @app.route("/send/<room_code>", methods=["POST"])
 def send_command(room_code):
-    if room_code not in rooms:
-        return jsonify({"error": "Room not found"}), 404
-    
-    data = request.json
-    command = data.get("command")
-    index = data.get("index")
-    extra_data = data.get("data")  # Get the data field
-    
-    # Store command with optional index and data
-    cmd_data = {"command": command}
-    if index is not None:
-        cmd_data["index"] = index
-    if extra_data is not None:
-        cmd_data["data"] = extra_data  # Include the data field
-    
-    rooms[room_code]["commands"].append(cmd_data)
-    print(f"📥 Room {room_code}: Stored command '{command}' with data: {extra_data is not None}")
-    return jsonify({"status": "ok"})
+    return reply(core.send(room_code, request.json))
 
 
 @app.route("/receive/<room_code>", methods=["GET"])
 def receive_command(room_code):
-    if room_code not in rooms:
-        return jsonify({"error": "Room not found"}), 404
-    
-    cmds = rooms[room_code]["commands"]
-    rooms[room_code]["commands"] = []  # Clear after sending
-    
-    if cmds:
-        print(f"📤 Room {room_code}: Sending {len(cmds)} command(s)")
-    
-    return jsonify({"commands": cmds})
+    core.metrics.inc("relay_poll_waiters")
+    try:
+        return reply(core.receive(room_code, request.args.get("since", 0, type=float),
+                                  request.args.get("client"), request.args.get("after", type=int)))
+    finally:
+        core.metrics.inc("relay_poll_waiters", amount=-1)
 
 
 @app.route("/join/<room_code>", methods=["POST"])
 def join_room(room_code):
-    if room_code not in rooms:
-        return jsonify({"error": "Room not found"}), 404
-    return jsonify({"status": "joined", "room_code": room_code})
+    body = json_object("client")
+    if body is None:
+        return reply(({"error": "Bad request"}, 400))
+    return reply(core.join(room_code, body.get("client")))
+
+
+@app.route("/blob/<room_code>/<key>", methods=["PUT"])
+def put_blob(room_code, key):
+    """Store a track chunk uploaded by the client that owns the track."""
+    return reply(core.put_blob(room_code, key, request.get_data()))
+
+
+@app.route("/blob/<room_code>/<key>", methods=["GET"])
+def get_blob(room_code, key):
+    """Fetch a track chunk (404 until the owner has uploaded it)."""
+    return reply(core.get_blob(room_code, key))
+
+
+@app.route("/members/<room_code>", methods=["GET"])
+def list_members(room_code):
+    """Members with last-seen time, cursor and lag behind the log."""
+    return reply(core.members(room_code))
 
 
 @app.route("/ping", methods=["GET"])
 def ping():
     """Keep-alive endpoint."""
-    return jsonify({"status": "alive", "timestamp": time.time()})
+    return reply(core.ping())
 
 
 @app.route("/rooms", methods=["GET"])
 def list_rooms():
     """List active rooms (for debugging)."""
-    return jsonify({
-        "rooms": list(rooms.keys()),
-        "count": len(rooms)
-    })
+    return reply(core.list_rooms())
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus scrape endpoint."""
+    return reply(core.metrics_text())
+
 
+@app.route("/ring", methods=["GET"])
+def ring():
+    """Node list of a sharded relay, for clients to find a room's node."""
+    if not hasattr(core, "ring_info"):
+        return reply(({"error": "Not found"}, 404))
+    return reply(core.ring_info())
 
-# Clean up old rooms
-def cleanup_old_rooms():
-    current_time = time.time()
-    to_delete = []
-    for room_code, room_data in rooms.items():
-        if current_time - room_data.get("created_at", 0) > ROOM_TIMEOUT:
-            to_delete.append(room_code)
-    
-    for room_code in to_delete:
-        del rooms[room_code]
-        print(f"Cleaned up room: {room_code}")
+
+@app.route("/ring", methods=["POST"])
+def set_ring():
+    """Change the node list (needs RELAY_RING_TOKEN)."""
+    if not hasattr(core, "set_ring"):
+        return reply(({"error": "Not found"}, 404))
+    return reply(core.set_ring(request.get_json(silent=True)))
 
 
 @app.before_request
 def before_request():
     """Run cleanup before each request."""
-    if len(rooms) > 0:
-        cleanup_old_rooms()
+    g.started = time.perf_counter()
+    core.cleanup_old_rooms()
+
+
+@app.after_request
+def after_request(response):
+    """Count the request and its latency per route."""
+    route = request.path.split("/")[1]
+    route = route if route in ROUTES else "other"
+    core.metrics.inc("relay_requests_total", (route, response.status_code))
+    if "started" in g:
+        core.metrics.observe("relay_request_seconds", time.perf_counter() - g.started, (route,))
+    return response
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080, debug=True)
+    # Production: gunicorn -w 4 -b 0.0.0.0:8080 relay_server:app (see RELAY_SHARED_DB)
+    app.run(host="0.0.0.0", port=8080, debug=RELAY_DEBUG, threaded=True)
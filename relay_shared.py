@@ -0,0 +1,614 @@
+"""
+Relay state shared by several worker processes.
+
+RelayCore keeps rooms in one process's memory, so only one worker can serve
+them. SharedRelayCore has the same methods and replies (the interface the
+HTTP layers use: host, join, send, receive, members, put_blob, get_blob,
+ping, list_rooms, metrics_text, cleanup_old_rooms) but keeps every room,
+command, member and blob in one SQLite database in WAL mode. Any number of
+processes can open it: writes are short BEGIN IMMEDIATE transactions, and
+reads (polls, by far the most common request) run concurrently with them.
+Metrics counters are per worker process. Retried sends are recognised by
+id (the last DEDUPE_WINDOW seqs of a room, in recent_ids, even after the
+command itself was pruned), and the byte budgets use RelayCore's eviction
+order: a room is checked on every write, the whole store each time a worker
+has written another 1/GLOBAL_CHECK_SHARE of the global budget.
+
+serve_workers() starts N stdlib relay processes on one port (SO_REUSEPORT)
+over a shared database; relay_server.py does the same under gunicorn when
+RELAY_SHARED_DB is set. Rate limits are per worker process.
+
+Run this file directly for the worker scaling benchmark. Extra workers
+only help with a free core each: on a single-core machine they share one
+CPU and the benchmark shows contention, not scaling.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from relay_core import (BLOB_BURST, BLOB_MEMORY_BUDGET, BLOB_RATE, BLOB_TTL, COMMAND_RETENTION, DEDUPE_WINDOW,
+                        GLOBAL_MEMORY_BUDGET, MAX_BLOB_SIZE, MAX_COMMAND_RETENTION, MAX_COMMAND_SIZE,
+                        MAX_ROOM_COMMANDS, MEMBER_TIMEOUT, MIN_COMMAND_RETENTION, PAUSE_COMMANDS,
+                        ROOM_MEMORY_BUDGET, ROOM_TIMEOUT, SEND_BURST, SEND_RATE, TRACK_COMMANDS,
+                        EmbeddedRelay, RateLimiter, build_command, is_queue_snapshot, rate_limited)
+from relay_log import log_event
+from relay_metrics import Metrics
+
+POOL_SIZE = 8               # SQLite connections per worker process (one per request thread was ~250 KB each)
+MEMBER_TOUCH_INTERVAL = 5.0  # an idle poll rewrites the member's last_seen at most this often
+CLEANUP_INTERVAL = 10.0      # seconds between expiry sweeps, per worker
+GLOBAL_CHECK_SHARE = 64      # re-sum the whole store after a worker writes 1/64 of the global budget
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rooms (
+    code TEXT PRIMARY KEY,
+    epoch TEXT,
+    seq INTEGER,
+    floor INTEGER,
+    host TEXT,
+    created_at REAL
+);
+CREATE TABLE IF NOT EXISTS commands (
+    room TEXT,
+    seq INTEGER,
+    id TEXT,
+    origin TEXT,
+    recipients TEXT,
+    command TEXT,
+    snapshot INTEGER,
+    body TEXT,
+    timestamp REAL,
+    PRIMARY KEY (room, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS recent_ids (
+    room TEXT,
+    id TEXT,
+    seq INTEGER,
+    PRIMARY KEY (room, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS recent_ids_by_seq ON recent_ids (room, seq);
+CREATE TABLE IF NOT EXISTS members (
+    room TEXT,
+    client TEXT,
+    joined_at REAL,
+    last_seen REAL,
+    cursor INTEGER,
+    PRIMARY KEY (room, client)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS blobs (
+    room TEXT,
+    key TEXT,
+    data BLOB,
+    stored_at REAL,
+    PRIMARY KEY (room, key)
+) WITHOUT ROWID;
+"""
+
+
+def _placeholders(values):
+    return ",".join("?" * len(values))
+
+
+class SharedRelayCore:
+    def __init__(self, path, room_timeout=ROOM_TIMEOUT, command_retention=COMMAND_RETENTION,
+                 blob_ttl=BLOB_TTL, max_blob_size=MAX_BLOB_SIZE, member_timeout=MEMBER_TIMEOUT,
+                 max_command_retention=MAX_COMMAND_RETENTION, room_budget=ROOM_MEMORY_BUDGET,
+                 global_budget=GLOBAL_MEMORY_BUDGET, max_command_size=MAX_COMMAND_SIZE,
+                 blob_budget=BLOB_MEMORY_BUDGET):
+        self.path = path
+        self.room_timeout = room_timeout
+        self.command_retention = command_retention
+        self.max_command_retention = max_command_retention
+        self.member_timeout = member_timeout
+        self.blob_ttl = blob_ttl
+        self.max_blob_size = max_blob_size
+        self.max_command_size = max_command_size
+        self.room_budget = room_budget
+        self.blob_budget = blob_budget
+        self.global_budget = global_budget
+        self.send_limiter = RateLimiter(SEND_RATE, SEND_BURST)
+        self.blob_limiter = RateLimiter(BLOB_RATE, BLOB_BURST)
+        self.limiter_lock = threading.Lock()
+        self.metrics = Metrics()  # per worker process
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        self._last_cleanup = 0.0
+        self._unchecked_bytes = 0  # written by this worker since the store was last summed
+        db = sqlite3.connect(path, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        db.close()
+
+    # ----- connections -----
+
+    @contextmanager
+    def _db(self):
+        """Borrow a connection from this process's pool (never reuse one across fork)."""
+        with self._pool_lock:
+            if self._pool_pid != os.getpid():
+                self._pool, self._pool_pid = queue.LifoQueue(), os.getpid()
+                for _ in range(POOL_SIZE):
+                    self._pool.put(None)  # opened on first use
+        pool = self._pool
+        db = pool.get()
+        try:
+            if db is None:
+                db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+                db.execute("PRAGMA synchronous=NORMAL")
+            yield db
+        finally:
+            pool.put(db)
+
+    @contextmanager
+    def _write(self):
+        with self._db() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    @contextmanager
+    def _read(self):
+        # One snapshot for the whole reply, so seq and commands agree
+        with self._db() as db:
+            db.execute("BEGIN")
+            try:
+                yield db
+            finally:
+                db.execute("COMMIT")
+
+    # ----- rooms -----
+
+    def host(self, room_code=None, client=None):
+        """Create a room; room_code recreates a known room after a relay restart."""
+        now = time.time()
+        with self._write() as db:
+            if room_code is None:
+                room_code = str(uuid.uuid4())[:6].upper()  # 6-character room code
+                while db.execute("SELECT 1 FROM rooms WHERE code = ?", (room_code,)).fetchone():
+                    room_code = str(uuid.uuid4())[:6].upper()
+            elif db.execute("SELECT 1 FROM rooms WHERE code = ?", (room_code,)).fetchone():
+                return {"error": "Room already exists"}, 409
+            epoch = uuid.uuid4().hex[:8]
+            db.execute("INSERT INTO rooms VALUES (?, ?, 0, 0, ?, ?)", (room_code, epoch, client, now))
+            if client:
+                self._touch_member(db, room_code, client, 0, now)
+        return {"room_code": room_code, "epoch": epoch, "seq": 0, "host": client, "timestamp": now}, 200
+
+    def join(self, room_code, client=None):
+        now = time.time()
+        with self._write() as db:
+            row = db.execute("SELECT epoch, seq, host FROM rooms WHERE code = ?", (room_code,)).fetchone()
+            if row is None:
+                return {"error": "Room not found"}, 404
+            epoch, seq, host = row
+            if client:
+                self._touch_member(db, room_code, client, seq, now)
+                if host is None:
+                    host = self._promote_host(db, room_code, None, now)
+        return {"status": "joined", "room_code": room_code, "epoch": epoch,
+                "seq": seq, "host": host, "timestamp": now}, 200
+
+    def list_rooms(self):
+        """List active rooms (for debugging)."""
+        with self._read() as db:
+            rooms = [code for (code,) in db.execute("SELECT code FROM rooms")]
+            stored = db.execute("SELECT coalesce(sum(length(body)), 0) FROM commands").fetchone()[0]
+            stored += db.execute("SELECT coalesce(sum(length(data)), 0) FROM blobs").fetchone()[0]
+        return {"rooms": rooms, "count": len(rooms), "bytes": stored}, 200
+
+    def ping(self):
+        """Keep-alive endpoint."""
+        return {"status": "alive", "timestamp": time.time()}, 200
+
+    def metrics_text(self):
+        """Prometheus text for GET /metrics; counters are this worker's, gauges the whole store's."""
+        with self._read() as db:
+            rooms = db.execute("SELECT count(*) FROM rooms").fetchone()[0]
+            members = db.execute("SELECT count(*) FROM members").fetchone()[0]
+            queued, deepest = db.execute("SELECT coalesce(sum(n), 0), coalesce(max(n), 0) FROM "
+                                         "(SELECT count(*) AS n FROM commands GROUP BY room)").fetchone()
+            stored = db.execute("SELECT coalesce(sum(length(body)), 0) FROM commands").fetchone()[0]
+            stored += db.execute("SELECT coalesce(sum(length(data)), 0) FROM blobs").fetchone()[0]
+        return self.metrics.render({
+            "relay_rooms": rooms,
+            "relay_members": members,
+            "relay_queued_commands": queued,
+            "relay_room_queue_depth_max": deepest,
+            "relay_stored_bytes": stored,
+        }), 200
+
+    def cleanup_old_rooms(self):
+        now = time.time()
+        if now - self._last_cleanup < CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = now
+        with self._write() as db:
+            # Departed members first, so rooms that lost their host get a new one
+            stale = [room for (room,) in db.execute(
+                "SELECT DISTINCT room FROM members WHERE last_seen < ?", (now - self.member_timeout,))]
+            for room in stale:
+                self._expire_members(db, room, now)
+            # A room lives while anyone is still polling it, whoever hosted it
+            expired = [code for (code,) in db.execute(
+                "SELECT code FROM rooms WHERE max(created_at, coalesce("
+                "(SELECT max(last_seen) FROM members WHERE members.room = rooms.code), 0)) < ?",
+                (now - self.room_timeout,))]
+            for table, column in (("rooms", "code"), ("commands", "room"), ("members", "room"), ("blobs", "room"),
+                                  ("recent_ids", "room")):
+                db.executemany(f"DELETE FROM {table} WHERE {column} = ?", [(c,) for c in expired])
+        if expired:
+            self.metrics.inc("relay_rooms_expired_total", amount=len(expired))
+        for room_code in expired:
+            log_event(logging.INFO, "room_expired", room=room_code)
+
+    # ----- members -----
+
+    def _touch_member(self, db, room_code, client, cursor, now):
+        db.execute("INSERT INTO members VALUES (?, ?, ?, ?, ?) ON CONFLICT (room, client) DO UPDATE "
+                   "SET last_seen = excluded.last_seen, cursor = coalesce(excluded.cursor, cursor)",
+                   (room_code, client, now, now, cursor))
+
+    def _expire_members(self, db, room_code, now):
+        gone = [client for (client,) in db.execute(
+            "SELECT client FROM members WHERE room = ? AND last_seen < ?", (room_code, now - self.member_timeout))]
+        if not gone:
+            return
+        db.execute("DELETE FROM members WHERE room = ? AND last_seen < ?", (room_code, now - self.member_timeout))
+        self.metrics.inc("relay_members_expired_total", amount=len(gone))
+        for client in gone:
+            log_event(logging.INFO, "member_left", room=room_code, client=client, silent_for=self.member_timeout)
+        row = db.execute("SELECT host FROM rooms WHERE code = ?", (room_code,)).fetchone()
+        if row and row[0] in gone:
+            self._promote_host(db, room_code, row[0], now)
+
+    def _promote_host(self, db, room_code, previous, now):
+        """Hand host authority to the longest-standing member (deterministic)."""
+        row = db.execute("SELECT client FROM members WHERE room = ? ORDER BY joined_at, client LIMIT 1",
+                         (room_code,)).fetchone()
+        new_host = row[0] if row else None
+        db.execute("UPDATE rooms SET host = ? WHERE code = ?", (new_host, room_code))
+        if new_host is not None:
+            self._append(db, room_code, {"command": "host_changed",
+                                         "data": {"host": new_host, "previous": previous}}, now)
+            self.metrics.inc("relay_hosts_promoted_total")
+            log_event(logging.INFO, "host_promoted", room=room_code, previous=previous, host=new_host)
+        return new_host
+
+    def members(self, room_code):
+        """Who is in the room, when we last heard from them and how far behind the log they are."""
+        now = time.time()
+        with self._write() as db:
+            row = db.execute("SELECT seq, host FROM rooms WHERE code = ?", (room_code,)).fetchone()
+            if row is None:
+                return {"error": "Room not found"}, 404
+            self._expire_members(db, room_code, now)
+            seq, host = db.execute("SELECT seq, host FROM rooms WHERE code = ?", (room_code,)).fetchone()
+            result = []
+            for client, joined_at, last_seen, cursor in db.execute(
+                    "SELECT client, joined_at, last_seen, cursor FROM members WHERE room = ?", (room_code,)).fetchall():
+                lag = seq - cursor if cursor is not None else None
+                oldest_unread = db.execute(
+                    "SELECT min(timestamp) FROM commands WHERE room = ? AND seq > ?",
+                    (room_code, cursor)).fetchone()[0] if lag else None
+                result.append({
+                    "client": client,
+                    "last_seen": last_seen,
+                    "joined_at": joined_at,
+                    "cursor": cursor,
+                    "lag": lag,
+                    "lag_seconds": round(now - oldest_unread, 3) if oldest_unread else 0.0,
+                })
+        return {"members": result, "host": host, "seq": seq, "timestamp": now}, 200
+
+    # ----- commands -----
+
+    def _append(self, db, room_code, cmd_data, now):
+        seq = db.execute("UPDATE rooms SET seq = seq + 1 WHERE code = ? RETURNING seq", (room_code,)).fetchone()[0]
+        cmd_data["seq"] = seq
+        cmd_data["timestamp"] = now
+        to = cmd_data.get("to")
+        db.execute("INSERT INTO commands VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+            room_code, seq, cmd_data.get("id"), cmd_data.get("origin"),
+            json.dumps(to) if to is not None else None, cmd_data["command"],
+            int(is_queue_snapshot(cmd_data)), json.dumps(cmd_data), now))
+        if cmd_data.get("id"):
+            db.execute("INSERT OR REPLACE INTO recent_ids VALUES (?, ?, ?)", (room_code, cmd_data["id"], seq))
+            db.execute("DELETE FROM recent_ids WHERE room = ? AND seq <= ?", (room_code, seq - DEDUPE_WINDOW))
+        return seq
+
+    def _compact(self, db, room_code, cmd_data):
+        """Drop logged commands that cmd_data supersedes (same rules as RelayCore)."""
+        command = cmd_data["command"]
+        broadcast = "room = ? AND recipients IS NULL"
+        if command in TRACK_COMMANDS:
+            moot = list(TRACK_COMMANDS | PAUSE_COMMANDS)
+            dropped = db.execute(f"DELETE FROM commands WHERE {broadcast} AND command IN ({_placeholders(moot)})",
+                                 (room_code, *moot))
+        elif command in PAUSE_COMMANDS:
+            tracks = list(TRACK_COMMANDS)
+            pauses = list(PAUSE_COMMANDS)
+            dropped = db.execute(f"DELETE FROM commands WHERE {broadcast} AND command IN ({_placeholders(pauses)}) "
+                                 f"AND seq > coalesce((SELECT max(seq) FROM commands WHERE room = ? "
+                                 f"AND command IN ({_placeholders(tracks)})), 0)",
+                                 (room_code, *pauses, room_code, *tracks))
+        elif is_queue_snapshot(cmd_data):
+            dropped = db.execute(f"DELETE FROM commands WHERE {broadcast} AND snapshot = 1 AND origin IS ?",
+                                 (room_code, cmd_data.get("origin")))
+        else:
+            return
+        if dropped.rowcount > 0:
+            self.metrics.inc("relay_commands_compacted_total", amount=dropped.rowcount)
+
+    def _prune_commands(self, db, room_code, now):
+        """Drop commands every active member has read (or that waited too long)."""
+        count, slowest, unknown = db.execute(
+            "SELECT count(*), min(cursor), sum(cursor IS NULL) FROM members WHERE room = ? AND last_seen >= ?",
+            (room_code, now - self.member_timeout)).fetchone()
+        if count and not unknown:
+            where = ("room = ? AND (timestamp < ? OR (seq <= ? AND timestamp < ?))",
+                     (room_code, now - self.max_command_retention, slowest, now - MIN_COMMAND_RETENTION))
+        else:
+            # Someone polls by timestamp only (or nobody is known): keep by age
+            where = ("room = ? AND timestamp < ?", (room_code, now - self.command_retention))
+        self._evict(db, room_code, *where)
+        overflow = db.execute("SELECT count(*) FROM commands WHERE room = ?", (room_code,)).fetchone()[0] - MAX_ROOM_COMMANDS
+        if overflow > 0:
+            self._evict(db, room_code, "room = ? AND seq <= (SELECT seq FROM commands WHERE room = ? "
+                                       "ORDER BY seq LIMIT 1 OFFSET ?)", (room_code, room_code, overflow - 1))
+
+    def _evict(self, db, room_code, where, args):
+        """Delete commands; members behind them will see a gap."""
+        last = db.execute(f"SELECT max(seq) FROM commands WHERE {where}", args).fetchone()[0]
+        if last is not None:
+            pruned = db.execute(f"DELETE FROM commands WHERE {where}", args).rowcount
+            self.metrics.inc("relay_commands_pruned_total", amount=pruned)
+            db.execute("UPDATE rooms SET floor = max(floor, ?) WHERE code = ?", (last, room_code))
+
+    # ----- memory -----
+
+    def _evict_oldest(self, db, room_code):
+        """Drop the room's oldest blob (or command, once it has no blobs); returns the bytes freed."""
+        # Blobs can be uploaded again, the command log can't
+        row = db.execute("SELECT key, length(data) FROM blobs WHERE room = ? ORDER BY stored_at LIMIT 1",
+                         (room_code,)).fetchone()
+        if row:
+            db.execute("DELETE FROM blobs WHERE room = ? AND key = ?", (room_code, row[0]))
+            return max(row[1], 1)
+        row = db.execute("SELECT seq, length(body) FROM commands WHERE room = ? ORDER BY seq LIMIT 1",
+                         (room_code,)).fetchone()
+        if row:
+            self._evict(db, room_code, "room = ? AND seq = ?", (room_code, row[0]))
+            return max(row[1], 1)
+        return 0
+
+    def _enforce_budgets(self, db, room_code, written):
+        # Blobs and commands have separate budgets: a big track only pushes out older chunks
+        blob_bytes = db.execute("SELECT coalesce(sum(length(data)), 0) FROM blobs WHERE room = ?",
+                                (room_code,)).fetchone()[0]
+        while blob_bytes > self.blob_budget:
+            row = db.execute("SELECT key, length(data) FROM blobs WHERE room = ? ORDER BY stored_at LIMIT 1",
+                             (room_code,)).fetchone()
+            db.execute("DELETE FROM blobs WHERE room = ? AND key = ?", (room_code, row[0]))
+            blob_bytes -= row[1]
+        used = db.execute("SELECT coalesce(sum(length(body)), 0) FROM commands WHERE room = ?",
+                          (room_code,)).fetchone()[0]
+        while used > self.room_budget:
+            row = db.execute("SELECT seq, length(body) FROM commands WHERE room = ? ORDER BY seq LIMIT 1",
+                             (room_code,)).fetchone()
+            if not row:
+                break
+            self._evict(db, room_code, "room = ? AND seq = ?", (room_code, row[0]))
+            used -= row[1]
+        # Summing every room takes ~20 ms at 40k commands, too long to hold the write lock on each send
+        self._unchecked_bytes += written
+        if self._unchecked_bytes < self.global_budget // GLOBAL_CHECK_SHARE:
+            return
+        self._unchecked_bytes = 0
+        used = db.execute("SELECT (SELECT coalesce(sum(length(body)), 0) FROM commands) + "
+                          "(SELECT coalesce(sum(length(data)), 0) FROM blobs)").fetchone()[0]
+        while used > self.global_budget:
+            biggest = db.execute("SELECT room FROM (SELECT room, length(body) AS n FROM commands "
+                                 "UNION ALL SELECT room, length(data) FROM blobs) "
+                                 "GROUP BY room ORDER BY sum(n) DESC LIMIT 1").fetchone()
+            freed = self._evict_oldest(db, biggest[0]) if biggest else 0
+            if not freed:
+                break
+            used -= freed
+
+    def send(self, room_code, data):
+        try:
+            cmd_data = build_command(data)
+        except ValueError:
+            return {"error": "Bad request"}, 400
+        size = len(json.dumps(cmd_data))
+        if size > self.max_command_size:
+            self.metrics.inc("relay_rejected_total", ("too_large",))
+            return {"error": "Command too large", "max_size": self.max_command_size}, 413
+        now = time.time()
+        with self._write() as db:
+            if db.execute("SELECT 1 FROM rooms WHERE code = ?", (room_code,)).fetchone() is None:
+                return {"error": "Room not found"}, 404
+            if "id" in cmd_data:
+                # A client retrying a command we stored (its reply got lost), pruned or not
+                row = db.execute("SELECT seq FROM recent_ids WHERE room = ? AND id = ?",
+                                 (room_code, cmd_data["id"])).fetchone()
+                if row:
+                    self.metrics.inc("relay_rejected_total", ("duplicate",))
+                    return {"status": "duplicate", "seq": row[0]}, 200
+            with self.limiter_lock:
+                wait = self.send_limiter.acquire((room_code, cmd_data.get("origin")), now)
+            if wait:
+                self.metrics.inc("relay_rejected_total", ("rate_limited",))
+                return rate_limited(wait)
+            self._compact(db, room_code, cmd_data)
+            seq = self._append(db, room_code, cmd_data, now)
+            self._prune_commands(db, room_code, now)
+            self._enforce_budgets(db, room_code, size)
+        self.metrics.inc("relay_commands_total", (cmd_data["command"],))
+        self.metrics.observe("relay_command_bytes", size)
+        log_event(logging.DEBUG, "command_stored", room=room_code, command=cmd_data["command"], data="data" in cmd_data)
+        return {"status": "ok", "seq": seq}, 200
+
+    def receive(self, room_code, since=0.0, client=None, after=None):
+        """Commands newer than sequence number `after` (or server time `since`)."""
+        now = time.time()
+        if client:
+            self._heartbeat(room_code, client, after, now)
+        with self._read() as db:
+            row = db.execute("SELECT epoch, seq, floor, host FROM rooms WHERE code = ?", (room_code,)).fetchone()
+            if row is None:
+                return {"error": "Room not found"}, 404
+            epoch, seq, floor, host = row
+            gap = False
+            if after is not None and after > seq:
+                # A cursor from before a relay restart: replay the recreated room's whole log
+                gap, after = True, 0
+            if after is not None:
+                gap = gap or after < floor  # missed commands already pruned
+                rows = db.execute("SELECT body, origin, recipients FROM commands WHERE room = ? AND seq > ? "
+                                  "ORDER BY seq", (room_code, after)).fetchall()
+            else:
+                rows = db.execute("SELECT body, origin, recipients FROM commands WHERE room = ? "
+                                  "AND timestamp > ? AND timestamp <= ? ORDER BY seq",
+                                  (room_code, since, now)).fetchall()
+        # Don't echo a client's own commands back to it, and skip commands
+        # addressed to other members
+        cmds = [json.loads(body) for body, origin, recipients in rows
+                if not client or (origin != client and (recipients is None or client in json.loads(recipients)))]
+        if cmds:
+            self.metrics.inc("relay_commands_delivered_total", amount=len(cmds))
+            log_event(logging.DEBUG, "commands_delivered", room=room_code, count=len(cmds))
+        return {"commands": cmds, "epoch": epoch, "seq": seq, "gap": gap, "host": host, "timestamp": now}, 200
+
+    def _heartbeat(self, room_code, client, after, now):
+        """Record a poll; idle polls only write every MEMBER_TOUCH_INTERVAL so reads stay parallel."""
+        with self._db() as db:
+            row = db.execute("SELECT last_seen, cursor FROM members WHERE room = ? AND client = ?",
+                             (room_code, client)).fetchone()
+        moved = after is not None and (row is None or row[1] != after)
+        if row is not None and not moved and now - row[0] < MEMBER_TOUCH_INTERVAL:
+            return
+        with self._write() as db:
+            if db.execute("SELECT 1 FROM rooms WHERE code = ?", (room_code,)).fetchone() is None:
+                return
+            self._touch_member(db, room_code, client, after, now)
+            if moved:
+                self._prune_commands(db, room_code, now)
+
+    # ----- blobs -----
+
+    def put_blob(self, room_code, key, data):
+        """Store a track chunk uploaded by the client that owns the track."""
+        if len(data) > self.max_blob_size:
+            self.metrics.inc("relay_rejected_total", ("blob_too_large",))
+            return {"error": "Blob too large"}, 413
+        now = time.time()
+        with self._write() as db:
+            if db.execute("SELECT 1 FROM rooms WHERE code = ?", (room_code,)).fetchone() is None:
+                return {"error": "Room not found"}, 404
+            with self.limiter_lock:
+                wait = self.blob_limiter.acquire(room_code, now)
+            if wait:
+                self.metrics.inc("relay_rejected_total", ("blob_rate_limited",))
+                return rate_limited(wait)
+            db.execute("DELETE FROM blobs WHERE room = ? AND stored_at < ?", (room_code, now - self.blob_ttl))
+            db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)", (room_code, key, data, now))
+            self._enforce_budgets(db, room_code, len(data))
+        self.metrics.observe("relay_blob_bytes", len(data))
+        return {"status": "ok"}, 200
+
+    def get_blob(self, room_code, key):
+        """Fetch a track chunk (404 until the owner has uploaded it)."""
+        with self._read() as db:
+            if db.execute("SELECT 1 FROM rooms WHERE code = ?", (room_code,)).fetchone() is None:
+                return {"error": "Room not found"}, 404
+            row = db.execute("SELECT data FROM blobs WHERE room = ? AND key = ?", (room_code, key)).fetchone()
+        if row is None:
+            return {"error": "Blob not found"}, 404
+        return bytes(row[0]), 200
+
+
+# ---------------------------------------
+# WORKERS
+# ---------------------------------------
+
+def _worker(path, host, port):
+    relay = EmbeddedRelay(SharedRelayCore(path), host, port, reuse_port=True)
+    relay.httpd.serve_forever()
+
+
+def serve_workers(path, workers, host="0.0.0.0", port=8080):
+    """Start `workers` relay processes on one port over one shared room database."""
+    SharedRelayCore(path)  # create the schema before the workers race for it
+    processes = [multiprocessing.Process(target=_worker, args=(path, host, port), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    return processes
+
+
+if __name__ == "__main__":
+    import http.client
+    import socket
+    import tempfile
+
+    ROOMS, CLIENTS, SECONDS = 50, 8, 3.0
+
+    def load(port, codes, seconds, results):
+        """One client process: 9 polls to every send, keep-alive connection."""
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        requests_done, deadline, i = 0, time.time() + seconds, 0
+        me = uuid.uuid4().hex[:8]
+        while time.time() < deadline:
+            code = codes[i % len(codes)]
+            if i % 10 == 0:
+                body = json.dumps({"command": "queue_ops", "origin": me, "data": {"ops": []}})
+                conn.request("POST", f"/send/{code}", body, {"Content-Type": "application/json"})
+            else:
+                conn.request("GET", f"/receive/{code}?after={max(0, i - 20)}&client={me}")
+            conn.getresponse().read()
+            requests_done += 1
+            i += 1
+        results.put(requests_done)
+
+    def free_port():
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    print(f"{os.cpu_count()} CPU core(s), {CLIENTS} client processes, {SECONDS:.0f}s per run")
+    if (os.cpu_count() or 1) < 4:
+        print("⚠️ fewer cores than workers: the clients and workers share the CPU, "
+              "so these numbers don't show how the relay scales")
+    baseline = None
+    for workers in (1, 2, 4):
+        path = os.path.join(tempfile.mkdtemp(), "rooms.db")
+        port = free_port()
+        core = SharedRelayCore(path)
+        codes = [core.host(client="bench")[0]["room_code"] for _ in range(ROOMS)]
+        processes = serve_workers(path, workers, "127.0.0.1", port)
+        time.sleep(0.5)
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=load, args=(port, codes, SECONDS, results))
+                   for _ in range(CLIENTS)]
+        for client in clients:
+            client.start()
+        total = sum(results.get() for _ in clients)
+        for process in processes:
+            process.terminate()
+        rate = total / SECONDS
+        baseline = baseline or rate
+        print(f"{workers} worker(s): {rate:7.0f} req/s  ({rate / baseline:.2f}x)")
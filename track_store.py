@@ -0,0 +1,263 @@
+"""
+Content fingerprints for library tracks.
+
+Filenames are a poor identity: the same song can be saved under two names and
+two different songs can both be called "Fighter.mp3". A fingerprint is a hash
+of the file size plus a few sampled chunks (read through mmap), which is fast
+enough to run over a whole library and stable across renames and folders.
+Full-file hashing is available when exact matching matters more than speed.
+
+Fingerprints are cached per path together with size/mtime so they are only
+recomputed when a file changes, and are stored alongside the library.
+
+LibraryIndex keeps basename and fingerprint lookup maps for the library up to
+date as songs are added and hashed, so checking a shared playlist against the
+library is linear in the playlist size. Run this file directly to benchmark it.
+"""
+
+import hashlib
+import mmap
+import os
+import threading
+import time
+
+SAMPLE_SIZE = 64 * 1024       # bytes per sampled chunk
+FULL_HASH_BLOCK = 1024 * 1024
+
+
+def partial_fingerprint(path):
+    """Hash of size + start/middle/end chunks of the file."""
+    size = os.path.getsize(path)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode("ascii"))
+    with open(path, "rb") as f:
+        if size <= SAMPLE_SIZE * 3:
+            h.update(f.read())
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for offset in (0, size // 2 - SAMPLE_SIZE // 2, size - SAMPLE_SIZE):
+                    h.update(m[offset:offset + SAMPLE_SIZE])
+    return h.hexdigest()
+
+
+def full_fingerprint(path):
+    """Hash of the whole file."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(FULL_HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def fingerprint_key(fp):
+    """64-bit integer form of a fingerprint, used for set reconciliation."""
+    return int(fp[:16], 16)
+
+
+class FingerprintCache:
+    """path -> fingerprint, persisted as plain dicts in library.json."""
+
+    def __init__(self, entries=None, full=False):
+        self.entries = dict(entries or {})   # path -> {"size", "mtime", "fp"[, "full"]}
+        self.full = full
+        self.lock = threading.Lock()
+        self.listeners = []   # called as listener(path, fp, old_fp) when a fingerprint changes
+        self._jobs = []       # (paths, on_done) waiting for the worker thread
+        self._worker = None
+
+    def get(self, path, compute=True):
+        """Fingerprint for path, or None if the file is unreadable (or not cached and compute=False)."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            if not self.full or "full" in entry:
+                return entry["fp"]
+        if not compute:
+            return None
+
+        try:
+            entry = {"size": st.st_size, "mtime": st.st_mtime, "fp": partial_fingerprint(path)}
+            if self.full:
+                entry["full"] = full_fingerprint(path)
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            old = self.entries.get(path)
+            self.entries[path] = entry
+        old_fp = old["fp"] if old else None
+        if old_fp != entry["fp"]:
+            for listener in self.listeners:
+                listener(path, entry["fp"], old_fp)
+        return entry["fp"]
+
+    def same_content(self, path_a, path_b):
+        """True if both paths hold the same track (confirmed by full hash when enabled)."""
+        fp_a, fp_b = self.get(path_a), self.get(path_b)
+        if fp_a is None or fp_a != fp_b:
+            return False
+        if self.full:
+            return self.entries[path_a].get("full") == self.entries[path_b].get("full")
+        return True
+
+    def cached(self, path):
+        """Fingerprint from the cache without touching the disk."""
+        entry = self.entries.get(path)
+        return entry["fp"] if entry else None
+
+    def forget(self, path):
+        with self.lock:
+            old = self.entries.pop(path, None)
+        if old:
+            for listener in self.listeners:
+                listener(path, None, old["fp"])
+
+    def start_background(self, paths, on_done=None):
+        """Fingerprint any uncached paths on the worker thread.
+
+        Batches queue up behind each other; on_done(changed) runs on the
+        worker once its batch is hashed.
+        """
+        with self.lock:
+            self._jobs.append((list(paths), on_done))
+            if self._worker and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._work, daemon=True)
+            self._worker.start()
+
+    def _work(self):
+        while True:
+            with self.lock:
+                if not self._jobs:
+                    self._worker = None
+                    return
+                paths, on_done = self._jobs.pop(0)
+            changed = 0
+            for path in paths:
+                if self.cached(path) is None and self.get(path) is not None:
+                    changed += 1
+            if on_done:
+                on_done(changed)
+
+    def to_dict(self):
+        with self.lock:
+            return dict(self.entries)
+
+
+class LibraryIndex:
+    """Lookup maps over the library, kept current as songs are added and hashed."""
+
+    def __init__(self, cache, paths=()):
+        self.cache = cache
+        self.paths = set()
+        self.by_name = {}   # basename -> [paths]
+        self.by_fp = {}     # fingerprint -> [paths]
+        self.lock = threading.Lock()
+        cache.listeners.append(self._on_fingerprint)
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        with self.lock:
+            if path in self.paths:
+                return False
+            self.paths.add(path)
+            self.by_name.setdefault(os.path.basename(path), []).append(path)
+            fp = self.cache.cached(path)
+            if fp:
+                self.by_fp.setdefault(fp, []).append(path)
+        return True
+
+    def remove(self, path):
+        with self.lock:
+            if path not in self.paths:
+                return
+            self.paths.discard(path)
+            _unmap(self.by_name, os.path.basename(path), path)
+            fp = self.cache.cached(path)
+            if fp:
+                _unmap(self.by_fp, fp, path)
+
+    def _on_fingerprint(self, path, fp, old_fp):
+        with self.lock:
+            if path not in self.paths:
+                return
+            if old_fp:
+                _unmap(self.by_fp, old_fp, path)
+            if fp:
+                self.by_fp.setdefault(fp, []).append(path)
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def find(self, fp=None, name=None):
+        """A library path with this fingerprint (preferred) or basename, or None."""
+        if fp and self.by_fp.get(fp):
+            return self.by_fp[fp][0]
+        if name and self.by_name.get(name):
+            return self.by_name[name][0]
+        return None
+
+    def has(self, song, fp=None):
+        """True if we own this (possibly remote) song, by fingerprint when known."""
+        if fp:
+            return bool(self.by_fp.get(fp))
+        return bool(self.by_name.get(os.path.basename(song)))
+
+    def missing(self, songs, fingerprints=None):
+        """Basenames of songs we don't own. O(len(songs))."""
+        fingerprints = fingerprints or {}
+        return [os.path.basename(song) for song in songs if not self.has(song, fingerprints.get(song))]
+
+
+def _unmap(index, key, path):
+    paths = index.get(key)
+    if paths and path in paths:
+        paths.remove(path)
+        if not paths:
+            del index[key]
+
+
+# ---------------------------------------
+# BENCHMARK
+# ---------------------------------------
+
+def _bench(playlist_size, library_size):
+    library = [f"C:/Music/Artist {i}/Track {i}.mp3" for i in range(library_size)]
+    playlist = [f"/home/peer/music/Track {i * 7}.mp3" for i in range(playlist_size)]
+
+    cache = FingerprintCache({p: {"size": 0, "mtime": 0, "fp": f"{i:032x}"} for i, p in enumerate(library)})
+    start = time.perf_counter()
+    index = LibraryIndex(cache, library)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    missing = index.missing(playlist)
+    check = time.perf_counter() - start
+
+    line = (f"playlist {playlist_size:>6} x library {library_size:>7} | index build {build * 1000:7.1f} ms "
+            f"| missing check {check * 1000:7.2f} ms ({len(missing)} missing)")
+
+    # The old per-song scan over the whole library, for comparison. On big
+    # sizes it is timed on an evenly spread sample and scaled up.
+    step = max(1, min(playlist_size // 20, playlist_size * library_size // 1_000_000))
+    sample = playlist[::step]
+    start = time.perf_counter()
+    old = [os.path.basename(s) for s in sample
+           if not any(os.path.basename(l) == os.path.basename(s) for l in library)]
+    old_ms = (time.perf_counter() - start) * 1000 * playlist_size / len(sample)
+    line += f" | old scan {old_ms:9.1f} ms" + (f" (extrapolated from {len(sample)} songs)" if step > 1 else "")
+    sampled = {os.path.basename(s) for s in sample}
+    assert old == [name for name in missing if name in sampled]
+    print(line)
+
+
+if __name__ == "__main__":
+    for playlist_size, library_size in ((200, 4_000), (2_000, 4_000), (2_000, 40_000), (20_000, 400_000)):
+        _bench(playlist_size, library_size)
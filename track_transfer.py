@@ -0,0 +1,326 @@
+"""
+Peer-to-peer transfer of missing tracks.
+
+A track is described by a manifest: its fingerprint, name, size and a hash
+for every fixed-size chunk. Downloads write chunks into a .part file and
+record finished chunks next to it, so an interrupted transfer picks up where
+it left off. Chunks are fetched in parallel and verified before they are
+written.
+
+Chunks come from a source, tried in order:
+- LanSource:   the holder's TrackServer, straight over the local network
+- RelaySource: blobs the holder uploads to the relay's /blob endpoint
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from track_store import partial_fingerprint
+
+CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024     # largest chunk_size we accept in a peer's manifest
+MAX_TRACK_SIZE = 2 * 1024 ** 3       # largest track we preallocate space for
+UPLOAD_RETRIES = 5       # times a rate-limited blob upload is retried
+PARALLEL_CHUNKS = 4
+LAN_TIMEOUT = 2          # seconds, a LAN peer that is this slow isn't really on our LAN
+RELAY_BLOB_WAIT = 60     # seconds to wait for the holder to upload a chunk to the relay
+FP_PATTERN = re.compile(r"[0-9a-f]+")
+
+
+def chunk_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def read_chunk(path, index, chunk_size=CHUNK_SIZE):
+    with open(path, "rb") as f:
+        f.seek(index * chunk_size)
+        return f.read(chunk_size)
+
+
+def build_manifest(path, fp):
+    """Chunk hashes for a local file."""
+    chunks = []
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            chunks.append(chunk_hash(block))
+    return {
+        "fp": fp,
+        "name": os.path.basename(path),
+        "size": os.path.getsize(path),
+        "chunk_size": CHUNK_SIZE,
+        "chunks": chunks,
+    }
+
+
+# ---------------------------------------
+# SERVING (holder side)
+# ---------------------------------------
+
+class TrackServer:
+    """Serves manifests and chunks of library tracks to peers on the LAN.
+
+    lookup(fp) returns the local path for a fingerprint, or None.
+    """
+
+    def __init__(self, lookup, host="0.0.0.0", port=0):
+        self.lookup = lookup
+        self.manifests = {}
+        self.stream_segments = {}   # "stream_id/seq" -> bytes, recent live stream segments
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                try:
+                    if len(parts) == 2 and parts[0] == "manifest":
+                        body = json.dumps(server.manifest(parts[1])).encode("utf-8")
+                        self._send(200, body, "application/json")
+                    elif len(parts) == 3 and parts[0] == "chunk":
+                        path = server.lookup(parts[1])
+                        self._send(200, read_chunk(path, int(parts[2])), "application/octet-stream")
+                    elif len(parts) == 3 and parts[0] == "stream":
+                        segment = server.stream_segments.get(f"{parts[1]}/{parts[2]}")
+                        if segment is None:
+                            self._send(404, b"", "text/plain")
+                        else:
+                            self._send(200, segment, "application/octet-stream")
+                    else:
+                        self._send(404, b"", "text/plain")
+                except (TypeError, ValueError, OSError):
+                    self._send(404, b"", "text/plain")
+
+            def _send(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # keep the console for app messages
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+
+    def manifest(self, fp):
+        if fp not in self.manifests:
+            path = self.lookup(fp)
+            if path is None:
+                raise ValueError("unknown track")
+            self.manifests[fp] = build_manifest(path, fp)
+        return self.manifests[fp]
+
+    def publish_segment(self, stream_id, seq, data, keep=16):
+        """Make a live stream segment available to LAN listeners."""
+        self.stream_segments[f"{stream_id}/{seq}"] = data
+        while len(self.stream_segments) > keep:
+            del self.stream_segments[next(iter(self.stream_segments))]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+
+# ---------------------------------------
+# SOURCES (downloader side)
+# ---------------------------------------
+
+class LanSource:
+    name = "LAN"
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def fetch_manifest(self, fp):
+        res = self.session.get(f"{self.base_url}/manifest/{fp}", timeout=LAN_TIMEOUT)
+        res.raise_for_status()
+        return res.json()
+
+    def prepare(self, fp, indices):
+        pass
+
+    def fetch_chunk(self, fp, index):
+        res = self.session.get(f"{self.base_url}/chunk/{fp}/{index}", timeout=LAN_TIMEOUT * 5)
+        res.raise_for_status()
+        return res.content
+
+
+class RelaySource:
+    """Chunks relayed through the relay's blob store.
+
+    request_upload(fp, indices) must ask the holder (via a room command) to
+    upload those chunks to /blob/<room>/<fp>.<index>; an empty list asks for
+    the manifest at /blob/<room>/<fp>.manifest.
+    """
+    name = "relay"
+
+    def __init__(self, relay_url, room_code, request_upload):
+        self.base_url = f"{relay_url}/blob/{room_code}"
+        self.request_upload = request_upload
+        self.session = requests.Session()
+
+    def fetch_manifest(self, fp):
+        self.request_upload(fp, [])
+        return json.loads(self._wait_for(f"{fp}.manifest"))
+
+    def prepare(self, fp, indices):
+        self.request_upload(fp, list(indices))
+
+    def fetch_chunk(self, fp, index):
+        return self._wait_for(f"{fp}.{index}")
+
+    def _wait_for(self, key):
+        deadline = time.time() + RELAY_BLOB_WAIT
+        delay = 0.2
+        while True:
+            res = self.session.get(f"{self.base_url}/{key}", timeout=10)
+            if res.status_code == 200:
+                return res.content
+            if time.time() > deadline:
+                raise TimeoutError(f"{key} never reached the relay")
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+
+
+def upload_to_relay(relay_url, room_code, path, fp, indices):
+    """Holder side of RelaySource: push the manifest (no indices) or the requested chunks."""
+    session = requests.Session()
+    base_url = f"{relay_url}/blob/{room_code}/{fp}"
+    if not indices:
+        body = json.dumps(build_manifest(path, fp)).encode("utf-8")
+        _put_blob(session, f"{base_url}.manifest", body)
+        return
+    for index in indices:
+        _put_blob(session, f"{base_url}.{index}", read_chunk(path, index))
+
+
+def _put_blob(session, url, body):
+    """PUT one blob, waiting out rate limits; raises if the relay won't take it."""
+    for _ in range(UPLOAD_RETRIES):
+        res = session.put(url, data=body, timeout=30)
+        if res.status_code != 429:
+            break
+        time.sleep(min(float(res.headers.get("Retry-After") or 1), 10))
+    res.raise_for_status()
+
+
+# ---------------------------------------
+# RESUMABLE DOWNLOAD
+# ---------------------------------------
+
+class Download:
+    """One track being fetched into dest_dir, resumable across restarts.
+
+    The manifest comes from a peer, so its name and fingerprint are checked
+    before they touch the filesystem, and the finished file must hash to the
+    fingerprint we asked for.
+    """
+
+    def __init__(self, manifest, dest_dir, fp):
+        if not isinstance(manifest.get("fp"), str) or not FP_PATTERN.fullmatch(manifest["fp"]) \
+                or manifest["fp"] != fp:
+            raise ValueError(f"manifest is for {manifest.get('fp')!r}, not {fp}")
+        name = os.path.basename(str(manifest.get("name", "")).replace("\\", "/"))
+        if name in ("", ".", ".."):
+            raise ValueError(f"bad track name in manifest: {manifest.get('name')!r}")
+        size, chunk_size, chunks = manifest.get("size"), manifest.get("chunk_size"), manifest.get("chunks")
+        if type(size) is not int or not 0 <= size <= MAX_TRACK_SIZE:
+            raise ValueError(f"bad track size in manifest: {size!r}")
+        if type(chunk_size) is not int or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError(f"bad chunk size in manifest: {chunk_size!r}")
+        if not isinstance(chunks, list) or len(chunks) != -(-size // chunk_size) \
+                or not all(isinstance(c, str) for c in chunks):
+            raise ValueError(f"manifest chunk list doesn't cover {size} bytes")
+        self.manifest = dict(manifest, name=name)
+        self.dest_dir = dest_dir
+        os.makedirs(dest_dir, exist_ok=True)
+        self.part_path = os.path.join(dest_dir, f".{manifest['fp']}.part")
+        self.state_path = os.path.join(dest_dir, f".{manifest['fp']}.json")
+        self.lock = threading.Lock()
+        self.done = self._load_state()
+
+        if not os.path.exists(self.part_path):
+            with open(self.part_path, "wb") as f:
+                f.truncate(manifest["size"])
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("chunks") == self.manifest["chunks"] and os.path.exists(self.part_path):
+                return set(state.get("done", []))
+        except (OSError, json.JSONDecodeError):
+            pass
+        return set()
+
+    def _save_state(self):
+        with open(self.state_path, "w", encoding="utf-8") as f:
+            json.dump({"chunks": self.manifest["chunks"], "done": sorted(self.done)}, f)
+
+    def missing_chunks(self):
+        return [i for i in range(len(self.manifest["chunks"])) if i not in self.done]
+
+    def _store(self, index, data):
+        if chunk_hash(data) != self.manifest["chunks"][index]:
+            raise ValueError(f"chunk {index} failed its hash check")
+        with self.lock:
+            with open(self.part_path, "r+b") as f:
+                f.seek(index * self.manifest["chunk_size"])
+                f.write(data)
+            self.done.add(index)
+            self._save_state()
+
+    def _fetch(self, sources, index):
+        last_error = None
+        for source in sources:
+            try:
+                self._store(index, source.fetch_chunk(self.manifest["fp"], index))
+                return
+            except Exception as e:
+                last_error = e
+        raise last_error or RuntimeError("no sources")
+
+    def run(self, sources, workers=PARALLEL_CHUNKS, progress=None):
+        """Fetch every missing chunk and return the final file path."""
+        missing = self.missing_chunks()
+        for source in sources:
+            source.prepare(self.manifest["fp"], missing)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self._fetch, sources, i) for i in missing]
+            for future in futures:
+                future.result()
+                if progress:
+                    progress(len(self.done), len(self.manifest["chunks"]))
+
+        return self._finish()
+
+    def _finish(self):
+        if partial_fingerprint(self.part_path) != self.manifest["fp"]:
+            # Every chunk matched the manifest, so the manifest itself was wrong
+            os.remove(self.part_path)
+            os.remove(self.state_path)
+            raise ValueError(f"downloaded file does not match fingerprint {self.manifest['fp']}")
+        name = self.manifest["name"]
+        final = os.path.join(self.dest_dir, name)
+        stem, ext = os.path.splitext(name)
+        n = 1
+        while os.path.exists(final):
+            final = os.path.join(self.dest_dir, f"{stem} ({n}){ext}")
+            n += 1
+        os.replace(self.part_path, final)
+        os.remove(self.state_path)
+        return final
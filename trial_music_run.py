@@ -7,10 +7,26 @@ import random
 import pygame
 import json
 import threading, time, requests
+import uuid
+import itertools
+import queue
+import socket
+import types
 from tkinter import *
 from tkinter import filedialog, messagebox
 from tkinterdnd2 import TkinterDnD
 from tkinter import simpledialog, ttk
+from queue_crdt import SharedQueue
+from set_reconcile import IBLT, MIN_CELLS, reconcile, track_key
+from track_store import FingerprintCache, LibraryIndex, fingerprint_key
+from track_transfer import Download, LanSource, RelaySource, TrackServer, upload_to_relay
+from audio_stream import SEGMENT_SECONDS, STREAM_DELAY, StreamListener, StreamPublisher
+from lan_mode import LanClient, LanHub, discover_rooms
+from relay_core import RecentIds, serve_in_background
+from relay_log import setup_logging
+from relay_client import OutboundJournal, PollScheduler, new_command_id
+from relay_ring import HashRing
+from urllib.parse import urlparse
 
 
 # -----------------------------
@@ -28,14 +44,24 @@ root.resizable(False, False)
 # CONFIGURATION
 # ---------------------------------------
 
-RELAY_URL = "https://music-sync-relay.onrender.com"   # change this to your deployed relay
-POLL_INTERVAL = 2  # seconds between polling for commands
-KEEP_ALIVE_INTERVAL = 30  # seconds between keep-alive pings
+RELAY_SEED_URL = "https://music-sync-relay.onrender.com"   # change this to your deployed relay
+RELAY_URL = RELAY_SEED_URL  # relay (node) our room lives on, follows redirects of a sharded relay
+POLL_INTERVAL = 0.5  # seconds between polls while the room is active
+POLL_MAX_INTERVAL = 15  # polls back off to this while the room is idle
+LOCAL_RELAY_PORT = 8080  # port for "Host Locally" (our own relay, no cold start)
+KEEP_ALIVE_INTERVAL = 30  # longest the relay goes without hearing from us (polls double as heartbeats)
+FULL_HASHING = False  # also hash whole files to confirm duplicates (slower)
+AUTO_FETCH_MISSING = True  # download songs missing from a shared queue from peers that have them
+SEND_RETRIES = 2  # immediate resends of a command whose POST failed (safe: the relay dedupes by id)
+STREAM_VIA_RELAY = True  # also publish stream segments to the relay for listeners outside our LAN
+MAX_QUEUE_OPS_BYTES = 64 * 1024  # bigger queue edits (shuffles, loaded playlists) go out as one queue snapshot
+RECONCILE_TIMEOUT = 120  # seconds a library comparison waits for answers before it is forgotten
 
 pygame.mixer.init()
 
 LIBRARY_FILE = "library.json"
 PLAYLISTS_DIR = "playlists"
+DOWNLOADS_DIR = "downloads"
 os.makedirs(PLAYLISTS_DIR, exist_ok=True)
 current_index = 0
 paused = False
@@ -45,6 +71,28 @@ shuffled_order = []
 room_code = None
 session_active = False
 is_host = False
+client_id = uuid.uuid4().hex[:8]  # identifies this client in peer-to-peer exchanges
+outbound_seq = itertools.count(1)   # per-client sequence stamped on every command we send
+track_server = None               # serves our tracks to LAN peers while in a session
+active_downloads = {}             # fingerprint -> holder client id (None while waiting for an offer)
+clock_offset = 0.0                # relay clock minus local clock, estimated from polls
+best_clock_rtt = None
+streaming_mode = False            # host streams the playing track to listeners without it
+stream_publisher = None
+stream_info = None                # announcement of the stream we are publishing
+stream_listener = None
+pending_play = None               # Tk after() id of a track start held back until its room time
+lan_link = None                   # LanHub (when hosting) or LanClient while in a LAN session
+local_relay = None                # EmbeddedRelay when we host our own room
+relay_seed = RELAY_SEED_URL       # relay we route through: knows the node list of a sharded relay
+relay_ring = None                 # (relay URL it came from, HashRing or None) of a sharded relay
+poll_scheduler = PollScheduler(POLL_INTERVAL, min(POLL_MAX_INTERVAL, KEEP_ALIVE_INTERVAL))
+outbound_journal = OutboundJournal()  # commands waiting for the relay to come back
+outbox = queue.Queue()                # commands for the sender thread (None: just replay the journal)
+sender_thread = None
+applied_command_ids = RecentIds()      # ids of commands we already processed
+pending_reconciliations = {}   # token -> (sketch size, started at), for library comparisons we started
+answered_reconciliations = {}  # answer id -> (token, names only we have, answered at), for requests we answered
 
 
 # ---------------------------------------
@@ -63,15 +111,30 @@ def load_library():
     return []
 
 
+def load_fingerprints():
+    """Load cached content fingerprints stored next to the library."""
+    if os.path.exists(LIBRARY_FILE):
+        with open(LIBRARY_FILE, "r", encoding="utf-8") as f:
+            try:
+                return json.load(f).get("fingerprints", {})
+            except json.JSONDecodeError:
+                return {}
+    return {}
+
+
 def save_library():
     with open(LIBRARY_FILE, "w", encoding="utf-8") as f:
-        json.dump({"songs": library}, f, indent=2)
+        json.dump({"songs": library, "fingerprints": fingerprint_cache.to_dict()}, f, indent=2)
 
 
 def save_playlist():
     """Save current playlist order to a persistent file."""
     with open("current_playlist.json", "w", encoding="utf-8") as f:
-        json.dump({"playlist": playlist, "current_index": current_index}, f, indent=2)
+        json.dump({
+            "playlist": playlist,
+            "current_index": current_index,
+            "queue_state": queue_doc.to_dict()
+        }, f, indent=2)
 
 
 def load_saved_playlist():
@@ -80,10 +143,10 @@ def load_saved_playlist():
         try:
             with open("current_playlist.json", "r", encoding="utf-8") as f:
                 data = json.load(f)
-                return data.get("playlist", []), data.get("current_index", 0)
+                return data.get("playlist", []), data.get("current_index", 0), data.get("queue_state")
         except json.JSONDecodeError:
-            return [], 0
-    return [], 0
+            return [], 0, None
+    return [], 0, None
 
 
 
@@ -124,12 +187,7 @@ def add_songs():
         filetypes=(("Audio Files", "*.mp3;*.wav;*.ogg"), ("All Files", "*.*"))
     )
 
-    added = 0
-    for f in files:
-        if f not in library:
-            library.append(f)
-            added += 1
-        # REMOVED the lines that added to the playlist
+    added = add_to_library(files)
 
     save_library()
     # REMOVED save_playlist()
@@ -145,14 +203,7 @@ def add_folder():
         return
 
     files = [f for f in os.listdir(folder) if f.lower().endswith(('.mp3', '.wav', '.ogg'))]
-    added = 0
-
-    for file in files:
-        path = os.path.join(folder, file)
-        if path not in library:
-            library.append(path)
-            added += 1
-        # REMOVED the lines that added to the playlist
+    added = add_to_library(os.path.join(folder, file) for file in files)
 
     save_library()
     # REMOVED save_playlist()
@@ -161,6 +212,48 @@ def add_folder():
     update_status(f"Added {added} new songs from folder.")
 
 
+def add_to_library(paths):
+    """Add files to the library right away; songs we already own under another name are dropped
+    once the fingerprint worker has hashed them. Returns how many paths were new."""
+    global library_keys_memo
+    new_paths = [path for path in dict.fromkeys(paths) if path not in library_index]
+    for path in new_paths:
+        library.append(path)
+        library_index.add(path)
+    if new_paths:
+        library_keys_memo = None
+        fingerprint_cache.start_background(new_paths, on_done=lambda changed: find_duplicates(new_paths, changed))
+    return len(new_paths)
+
+
+def find_duplicates(new_paths, changed=0):
+    """On the fingerprint worker: drop newly added files that repeat a song we own."""
+    duplicates = {}
+    for path in new_paths:
+        fp = fingerprint_cache.get(path)
+        for existing in list(library_index.by_fp.get(fp, [])) if fp else []:
+            if existing != path and existing not in duplicates and fingerprint_cache.same_content(path, existing):
+                duplicates[path] = existing
+                break
+    if duplicates:
+        root.after(0, lambda: drop_duplicates(duplicates))
+    elif changed:
+        root.after(0, save_library)  # Keep the new fingerprints
+
+
+def drop_duplicates(duplicates):
+    global library_keys_memo
+    for path, existing in duplicates.items():
+        if path in library_index:
+            print(f"⚠️ Duplicate of {os.path.basename(existing)}: {path}")
+            library.remove(path)
+            library_index.remove(path)
+    library_keys_memo = None
+    save_library()
+    update_library_view()
+    update_status(f"Skipped {len(duplicates)} duplicate(s) of songs already in the library.")
+
+
 def on_library_double_click(event):
     """Add a song from the library to the playlist when double-clicked."""
     selection = playlist_box.curselection()
@@ -171,7 +264,7 @@ def on_library_double_click(event):
     if index < len(current_library_view):
         song_path = current_library_view[index] # <-- THIS IS THE FIX
         if song_path not in playlist:
-            playlist.append(song_path)
+            commit_queue_edit([queue_doc.append(song_path)])
             save_playlist()
             refresh_queue_view()
             update_status(f"Added to queue: {os.path.basename(song_path)}")
@@ -190,7 +283,7 @@ def add_selected_to_queue():
     if index < len(current_library_view):
         song_path = current_library_view[index] # <-- THIS IS THE FIX
         if song_path not in playlist:
-            playlist.append(song_path)
+            commit_queue_edit([queue_doc.append(song_path)])
             save_playlist()
             refresh_queue_view()
             update_status(f"Added to queue: {os.path.basename(song_path)}")
@@ -237,8 +330,8 @@ def load_playlist_from_file():
     with open(filepath, "r", encoding="utf-8") as f:
         data = json.load(f)
 
-    global playlist, current_index
-    playlist = data.get("songs", [])
+    global current_index
+    commit_queue_edit(queue_doc.replace(data.get("songs", [])))
     current_index = 0 if playlist else -1
     refresh_queue_view()
     save_playlist()
@@ -249,17 +342,46 @@ def load_playlist_from_file():
 # MUSIC CONTROL
 # ---------------------------------------
 def load_song(file_path):
-    global current_index, playlist, paused
+    """Play file_path; returns the room time playback starts at when it is held back for a stream."""
+    global current_index, paused
     if file_path not in playlist:
-        playlist.append(file_path)
+        commit_queue_edit([queue_doc.append(file_path)])
     current_index = playlist.index(file_path)
-    pygame.mixer.music.load(file_path)
-    pygame.mixer.music.play()
+    pygame.mixer.music.load(resolve_song_path(file_path))
+    start_at = None
+    if room_code and session_active and streaming_mode:
+        # Listeners hear the stream STREAM_DELAY late, so everybody starts then
+        start_at = start_stream(resolve_song_path(file_path))
+    play_at(start_at)
     paused = False
     refresh_queue_view()
     update_status(f"Playing: {os.path.basename(file_path)}")
     if room_code and session_active:
-        send_command("play", current_index)
+        send_command("play", current_index, data={"at": start_at} if start_at else None)
+    return start_at
+
+
+def play_at(start_at=None):
+    """Start the loaded track now, or at room time start_at."""
+    global pending_play
+    cancel_pending_play()
+    delay = start_at - room_time() if start_at else 0
+    if delay <= 0:
+        pygame.mixer.music.play()
+        return
+
+    def start():
+        global pending_play
+        pending_play = None
+        pygame.mixer.music.play()
+    pending_play = root.after(int(delay * 1000), start)
+
+
+def cancel_pending_play():
+    global pending_play
+    if pending_play is not None:
+        root.after_cancel(pending_play)
+        pending_play = None
 
 
 def play_pause_toggle():
@@ -279,12 +401,15 @@ def play_pause_toggle():
         update_status("Paused")
         if room_code and session_active:
             send_command("pause", current_index)
+            stop_stream()
     else:
         pygame.mixer.music.unpause()
         paused = False
         update_status(f"Playing: {os.path.basename(playlist[current_index])}")
         if room_code and session_active:
             send_command("unpause", current_index)
+            if streaming_mode:
+                stream_from_position(resolve_song_path(playlist[current_index]))
 
 
 def next_song(auto=False):
@@ -301,10 +426,10 @@ def next_song(auto=False):
     else:
         current_index = (current_index + 1) % len(playlist)
     refresh_queue_view()
-    load_song(playlist[current_index])
+    start_at = load_song(playlist[current_index])
     # Send command if in a network session
     if room_code and session_active:
-        send_command("next", current_index)
+        send_command("next", current_index, data={"at": start_at} if start_at else None)
 
 
 def prev_song():
@@ -313,17 +438,19 @@ def prev_song():
         return
     current_index = (current_index - 1) % len(playlist)
     refresh_queue_view()
-    load_song(playlist[current_index])
+    start_at = load_song(playlist[current_index])
     # Send command if in a network session
     if room_code and session_active:
-        send_command("prev", current_index)
+        send_command("prev", current_index, data={"at": start_at} if start_at else None)
 
 
 def stop_song():
+    cancel_pending_play()
     pygame.mixer.music.stop()
     update_status("Stopped")
     if room_code and session_active:
         send_command("stop", current_index)
+        stop_stream()
 
 
 def toggle_loop():
@@ -334,19 +461,20 @@ def toggle_loop():
 
 
 def shuffle_playlist():
-    global playlist, current_index
+    global current_index
     if not playlist:
         return
 
-    current_song = None
-    if current_index != -1 and current_index < len(playlist):
-        current_song = playlist[current_index]
+    new_order = list(range(len(playlist)))
+    random.shuffle(new_order)
 
-    random.shuffle(playlist)
+    # Keep the current song at the top
+    if 0 <= current_index < len(playlist):
+        new_order.remove(current_index)
+        new_order.insert(0, current_index)
 
-    if current_song and current_song in playlist:
-        playlist.remove(current_song)
-        playlist.insert(0, current_song)
+    commit_queue_edit(queue_doc.permute(new_order))
+    if 0 <= current_index < len(playlist):
         current_index = 0
 
     refresh_queue_view()
@@ -373,12 +501,9 @@ def remove_from_queue():
         stop_song() # Stop playback
         current_index = -1 # Reset current_index
         
-    # Pop the song from the playlist
-    removed_song = playlist.pop(index_to_remove)
-    
-    # Adjust current_index if a song *before* the playing song was removed
-    if current_index > index_to_remove:
-        current_index -= 1
+    # Remove the song from the shared queue (commit_queue_edit keeps current_index on the playing song)
+    removed_song = playlist[index_to_remove]
+    commit_queue_edit([queue_doc.remove(index_to_remove)])
         
     refresh_queue_view()
     save_playlist()
@@ -483,6 +608,12 @@ except FileNotFoundError:
 playlist = []
 library = load_library()
 current_library_view = [] # <-- NEW
+fingerprint_cache = FingerprintCache(load_fingerprints(), full=FULL_HASHING)
+library_index = LibraryIndex(fingerprint_cache, library)
+library_keys_memo = None  # library_keys() result, cleared when the library or a fingerprint changes
+fingerprint_cache.listeners.append(lambda path, fp, old_fp: globals().update(library_keys_memo=None))
+remote_fingerprints = {}  # peer song path -> fingerprint, learned from shared queues
+queue_doc = SharedQueue()  # shared 'Up Next' state, playlist is its visible view
 
 # ---------------------------------------
 # SONG END DETECTION
@@ -556,13 +687,7 @@ def on_drag_drop(event):
     if drop_index == drag_start_index or drag_start_index is None:
         return
 
-    current_song = playlist[current_index] if 0 <= current_index < len(playlist) else None
-
-    song = playlist.pop(drag_start_index)
-    playlist.insert(drop_index, song)
-
-    if current_song in playlist:
-        current_index = playlist.index(current_song)
+    commit_queue_edit([queue_doc.move(drag_start_index, drop_index)])
 
     refresh_queue_view()
     save_playlist()
@@ -593,6 +718,101 @@ def refresh_queue_view():
 # LIBRARY & PLAYLIST SYNC FUNCTIONS
 # ---------------------------------------
 
+def refresh_from_queue_doc():
+    """Rebuild the playlist view from the shared queue, keeping the current song selected."""
+    global playlist, current_index
+    current_song = playlist[current_index] if 0 <= current_index < len(playlist) else None
+    playlist = queue_doc.songs()
+    if current_song in playlist:
+        current_index = playlist.index(current_song)
+    elif current_index >= len(playlist):
+        current_index = len(playlist) - 1
+
+
+def commit_queue_edit(ops):
+    """Apply a local queue edit and share its ops with the room."""
+    refresh_from_queue_doc()
+    ops = [op for op in ops if op]
+    if ops and room_code and session_active:
+        # Tag new entries with their content fingerprint so peers can match them
+        ops = [tag_fingerprint(op) for op in ops]
+        if len(json.dumps(ops)) > MAX_QUEUE_OPS_BYTES:
+            # One op per song would outgrow the relay's command size, the final state doesn't
+            send_command("sync_playlist", data=queue_snapshot())
+        else:
+            send_command("queue_ops", data={"ops": ops})
+
+
+def tag_fingerprint(op):
+    """Copy of a queue insert op carrying the song's content fingerprint."""
+    if op["op"] != "ins":
+        return op
+    fp = fingerprint_cache.get(op["song"], compute=False)
+    return dict(op, fp=fp) if fp else op
+
+
+def queue_fingerprints(songs):
+    """song path -> fingerprint for songs we can fingerprint, sent with full queue syncs."""
+    fingerprints = {}
+    for song in songs:
+        fp = fingerprint_cache.get(song, compute=False)
+        if fp:
+            fingerprints[song] = fp
+    return fingerprints
+
+
+def resolve_song_path(song):
+    """Local file for a queue entry. Shared queues hold the sharer's paths, so match by content, then by name."""
+    if song in library_index or os.path.exists(song):
+        return song
+    return library_index.find(fp=remote_fingerprints.get(song), name=os.path.basename(song)) or song
+
+
+def apply_remote_queue_ops(ops):
+    """Merge queue ops from another client. No confirmation needed, edits merge."""
+    for op in ops:
+        if op.get("fp"):
+            remote_fingerprints[op["song"]] = op["fp"]
+    inserted = [op["song"] for op in ops if op.get("op") == "ins" and tuple(op["id"]) not in queue_doc.items]
+    if not queue_doc.apply_all(ops):
+        return
+    refresh_from_queue_doc()
+    refresh_queue_view()
+    save_playlist()
+    if inserted:
+        compare_playlists(inserted)
+    update_status(f"Queue updated by another client ({len(playlist)} songs)")
+
+
+def apply_remote_queue_state(state, fingerprints=None):
+    """Merge a full queue snapshot shared by another client."""
+    remote_fingerprints.update(fingerprints or {})
+    known = set(queue_doc.items)
+    if not queue_doc.merge_state(state):
+        print("✅ Shared queue already up to date.")
+        return
+    inserted = [
+        song for item_id, _, song, deleted, _ in state.get("items", [])
+        if not deleted and tuple(item_id) not in known
+    ]
+    refresh_from_queue_doc()
+    refresh_queue_view()
+    save_playlist()
+    if inserted:
+        compare_playlists(inserted)
+    update_status(f"Queue synced ({len(playlist)} songs)")
+
+
+def queue_snapshot():
+    """Full queue state for a sync_playlist command."""
+    return {
+        "playlist": playlist,
+        "current_index": current_index,
+        "queue_state": queue_doc.to_dict(),
+        "fingerprints": queue_fingerprints(playlist)
+    }
+
+
 def sync_current_queue():
     """Send current 'Up Next' queue to all connected clients."""
     if not room_code or not session_active:
@@ -612,12 +832,7 @@ def sync_current_queue():
     if not response:
         return
     
-    playlist_data = {
-        "playlist": playlist,
-        "current_index": current_index
-    }
-    
-    send_command("sync_playlist", data=playlist_data)
+    send_command("sync_playlist", data=queue_snapshot())
     messagebox.showinfo("Queue Shared", f"Your current queue ({len(playlist)} songs) has been shared!")
     update_status(f"Current queue synced ({len(playlist)} songs)")
 
@@ -625,6 +840,7 @@ def sync_current_queue():
 
 def share_saved_playlist():
     """Share a saved .json playlist from the /playlists folder."""
+    global current_index
     if not room_code or not session_active:
         update_status("Not in a network session")
         messagebox.showerror("Not Connected", "You must be in a network session to share a playlist.")
@@ -663,19 +879,17 @@ def share_saved_playlist():
         # Confirm before sending
         response = messagebox.askyesno(
             "Confirm Share",
-            f"Share the saved playlist '{name}' ({len(saved_playlist_songs)} songs) with all clients?"
+            f"Replace the shared queue with the saved playlist '{name}' ({len(saved_playlist_songs)} songs)?"
         )
         
         if not response:
             return
         
-        # Send the command with the playlist data
-        playlist_data = {
-            "playlist": saved_playlist_songs,
-            "current_index": 0  # Always start shared playlists from the beginning
-        }
-        
-        send_command("sync_playlist", data=playlist_data)
+        # Replacing the shared queue sends the edit to everyone as queue ops
+        commit_queue_edit(queue_doc.replace(saved_playlist_songs))
+        current_index = 0  # Always start shared playlists from the beginning
+        refresh_queue_view()
+        save_playlist()
         messagebox.showinfo("Playlist Shared", f"Saved playlist '{name}' has been shared!")
         update_status(f"Shared saved playlist: {name}")
 
@@ -696,14 +910,124 @@ def compare_libraries():
         messagebox.showinfo("Empty Library", "Your library is empty. Add some songs first!")
         return
     
-    # Request library from others
-    send_command("request_library")
+    # Send a compact sketch of our library, peers answer with only the differences
+    send_library_sketch(uuid.uuid4().hex[:8], MIN_CELLS)
     
     update_status("Requesting library from other clients...")
 
 
-def send_library_comparison(is_reply=False):
-    """Send our library info for comparison."""
+def library_keys():
+    """Map reconciliation keys (content fingerprints) to filenames for our library.
+
+    Only cached fingerprints are used (the worker hashes the rest), and the
+    map is kept until the library or a fingerprint changes.
+    """
+    global library_keys_memo
+    keys = library_keys_memo
+    if keys is None:
+        keys = {}
+        for song in library:
+            fp = fingerprint_cache.cached(song)
+            # Files not hashed yet (or unreadable) fall back to a name-based key
+            key = fingerprint_key(fp) if fp else track_key(os.path.basename(song))
+            keys[key] = os.path.basename(song)
+        library_keys_memo = keys
+    return keys
+
+
+def expire_reconciliations():
+    """Forget comparisons that peers stopped answering (left, or never had a reply to send)."""
+    cutoff = time.time() - RECONCILE_TIMEOUT
+    for token in [t for t, (_, started) in pending_reconciliations.items() if started < cutoff]:
+        del pending_reconciliations[token]
+    for answer in [a for a, (_, _, answered) in answered_reconciliations.items() if answered < cutoff]:
+        del answered_reconciliations[answer]
+
+
+def send_library_sketch(token, cells, to=None):
+    """Send an IBLT sketch of our library (a few KB regardless of library size).
+
+    The first sketch goes to the whole room; a bigger retry only to the peer that asked.
+    """
+    expire_reconciliations()
+    keys = library_keys()
+    sketch = IBLT.from_keys(keys, cells).to_wire()
+
+    # A sketch bigger than the plain filename list buys us nothing
+    if len(sketch) >= sum(len(name) + 4 for name in keys.values()):
+        print("⚠️ Library difference too large for a sketch, sending full library instead")
+        pending_reconciliations.pop(token, None)
+        send_library_comparison(to=to)
+        return
+
+    pending_reconciliations[token] = (cells, time.time())
+    send_command("request_library", data={
+        "token": token,
+        "cells": cells,
+        "library_count": len(keys),
+        "sketch": sketch
+    }, to=to)
+    print(f"✅ Sent library sketch: {len(keys)} songs in {len(sketch)} bytes ({cells} cells)")
+
+
+def answer_library_sketch(data, requester):
+    """Reconcile a peer's sketch against our library and send back just the difference."""
+    token = data.get("token")
+    if token in pending_reconciliations:
+        return  # Our own request coming back from the relay
+    expire_reconciliations()
+    if any(t == token for t, _, _ in answered_reconciliations.values()):
+        return  # Already answered, a bigger sketch was meant for another peer
+    if not library:
+        print("⚠️ Cannot answer library request: Library is empty")
+        return
+
+    keys = library_keys()
+    try:
+        ok, only_remote, only_local, next_cells = reconcile(
+            keys, data["sketch"], data["cells"], data.get("library_count", 0))
+    except (KeyError, ValueError) as e:
+        print(f"❌ Bad library sketch: {e}")
+        return
+
+    if not ok:
+        print(f"📤 Library sketch too small, asking for {next_cells} cells")
+        send_command("library_sketch_retry", data={"token": token, "cells": next_cells}, to=[requester] if requester else None)
+        return
+
+    answer = uuid.uuid4().hex[:8]
+    only_local_names = [keys[k] for k in only_local]
+    answered_reconciliations[answer] = (token, only_local_names, time.time())
+    send_command("library_diff", data={
+        "token": token,
+        "answer": answer,
+        "library_count": len(keys),
+        "only_sender": only_local_names,
+        "only_requester": [format(k, "016x") for k in only_remote]
+    }, to=[requester] if requester else None)
+    print(f"✅ Sent library difference: +{len(only_local)} / -{len(only_remote)}")
+
+
+def receive_library_diff(data, answerer):
+    """Show the comparison for a peer's answer to our sketch, then tell them our side."""
+    token = data.get("token")
+    if token not in pending_reconciliations:
+        return  # Answer to somebody else's comparison
+
+    keys = library_keys()
+    only_local = [keys[int(k, 16)] for k in data.get("only_requester", []) if int(k, 16) in keys]
+    only_remote = data.get("only_sender", [])
+    show_comparison_results(data.get("library_count", 0), only_local, only_remote, len(keys))
+
+    send_command("library_diff_reply", data={
+        "answer": data.get("answer"),
+        "library_count": len(keys),
+        "only_sender": only_local
+    }, to=[answerer] if answerer else None)
+
+
+def send_library_comparison(is_reply=False, to=None):
+    """Send our library info for comparison (to the given member ids, or the whole room)."""
     if not room_code or not session_active:
         print("⚠️ Cannot send library: Not in active session")
         return
@@ -721,33 +1045,38 @@ def send_library_comparison(is_reply=False):
         "is_reply": is_reply  # <-- Add the flag to the data payload
     }
     
-    send_command("library_comparison", data=comparison_data)
+    send_command("library_comparison", data=comparison_data, to=to)
     # Added is_reply to the print statement for better debugging
     print(f"✅ Sent library comparison: {len(library)} songs (is_reply: {is_reply})")
 
 
 def compare_playlists(received_playlist):
     """Compare received playlist with local library."""
-    missing_songs = []
-    
-    for song_path in received_playlist:
-        song_name = os.path.basename(song_path)
-        # Check if we have this song in our library
-        local_match = any(os.path.basename(local_song) == song_name for local_song in library)
-        
-        if not local_match:
-            missing_songs.append(song_name)
+    # Index lookups by content fingerprint (when the sender told us) or filename, linear in the playlist
+    missing_songs = library_index.missing(received_playlist, remote_fingerprints)
     
     if missing_songs:
         missing_text = "\n".join(missing_songs[:10])  # Show first 10
         if len(missing_songs) > 10:
             missing_text += f"\n... and {len(missing_songs) - 10} more"
+
+        # Songs we know the fingerprint of can be fetched from whoever has them
+        missing_fps = []
+        if AUTO_FETCH_MISSING and room_code and session_active:
+            for song in received_playlist:
+                fp = remote_fingerprints.get(song)
+                if fp and not library_index.has(song, fp):
+                    missing_fps.append(fp)
+            request_missing_tracks(missing_fps)
+        footer = ("Fetching them from peers that have them..." if missing_fps
+                  else "You may experience playback issues.")
         
-        messagebox.showwarning(
+        # This runs on the polling thread, so hand the dialog to the Tk main loop
+        root.after(0, lambda: messagebox.showwarning(
             "Missing Songs",
             f"⚠️ You are missing {len(missing_songs)} songs from this playlist:\n\n{missing_text}\n\n"
-            "You may experience playback issues."
-        )
+            + footer
+        ))
 
 
 def show_library_comparison(data):
@@ -756,31 +1085,31 @@ def show_library_comparison(data):
     remote_filenames = set(data.get("library_filenames", []))
     local_filenames = set(os.path.basename(song) for song in library)
     
-    # Find differences
+    # Find differences (our own report never gets here, see the origin check in process_command)
     only_local = local_filenames - remote_filenames
     only_remote = remote_filenames - local_filenames
-    common = local_filenames & remote_filenames
-    
-    # --- FIX 1: Ignore self-comparison ---
-    # If there are no differences in either direction,
-    # it means we are comparing our library to itself.
-    if not only_local and not only_remote:
-        print("✅ Ignoring self-comparison library report.")
-        return  # Don't show a popup for our own library!
-    # --- END FIX 1 ---
+
+    show_comparison_results(remote_count, only_local, only_remote)
+
+
+def show_comparison_results(remote_count, only_local, only_remote, local_count=None):
+    """Show the songs each side is missing in a dialog."""
+    if local_count is None:
+        local_count = len(library_index.by_name)
+    common = local_count - len(only_local)
 
     # --- FIX 2: Improved percentage calculation ---
     # Calculate percentage relative to *our* library
-    local_percent = int(len(common) / max(len(local_filenames), 1) * 100)
+    local_percent = int(common / max(local_count, 1) * 100)
     # Calculate percentage relative to *their* library
-    remote_percent = int(len(common) / max(remote_count, 1) * 100)
+    remote_percent = int(common / max(remote_count, 1) * 100)
 
     # Create comparison message
     msg = f"📊 Library Comparison Results\n"
     msg += f"{'='*50}\n\n"
     msg += f"Your library: {len(library)} songs\n"
     msg += f"Their library: {remote_count} songs\n"
-    msg += f"Songs in common: {len(common)}\n"
+    msg += f"Songs in common: {common}\n"
     msg += f"  • That's {local_percent}% of YOUR library\n"
     msg += f"  • That's {remote_percent}% of THEIR library\n\n"
     # --- END FIX 2 ---
@@ -829,6 +1158,275 @@ def show_library_comparison(data):
     update_status("Library comparison complete")
     
 
+# ---------------------------------------
+# TRACK TRANSFER (peer-to-peer)
+# ---------------------------------------
+
+def start_track_server():
+    """Serve our library to LAN peers by fingerprint."""
+    global track_server
+    if track_server is not None:
+        return
+    try:
+        track_server = TrackServer(lambda fp: library_index.find(fp=fp)).start()
+        print(f"✅ Track server listening on port {track_server.port}")
+    except OSError as e:
+        print(f"⚠️ Could not start track server: {e}")
+
+
+def local_ip():
+    """Our address on the local network, or None."""
+    try:
+        # No packets are sent, this just picks the interface used for outbound traffic
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("10.255.255.255", 1))
+            return s.getsockname()[0]
+    except OSError:
+        return None
+
+
+def local_lan_url():
+    """URL peers on the same network can reach our track server at."""
+    ip = local_ip()
+    if track_server is None or ip is None:
+        return None
+    return f"http://{ip}:{track_server.port}"
+
+
+def request_missing_tracks(fps):
+    """Ask the room who has these tracks."""
+    fps = [fp for fp in dict.fromkeys(fps) if fp not in active_downloads]
+    if not fps:
+        return
+    for fp in fps:
+        active_downloads[fp] = None
+    send_command("track_request", data={"requester": client_id, "fps": fps})
+    print(f"📤 Requested {len(fps)} missing track(s) from peers")
+
+
+def offer_tracks(data):
+    """Offer the requested tracks we own."""
+    if data.get("requester") == client_id:
+        return
+    have = [fp for fp in data.get("fps", []) if library_index.find(fp=fp)]
+    if have:
+        send_command("track_offer", data={
+            "requester": data["requester"],
+            "holder": client_id,
+            "fps": have,
+            "lan_url": local_lan_url()
+        })
+
+
+def accept_track_offer(data):
+    """Start downloading offered tracks we are still waiting for (first offer wins)."""
+    if data.get("requester") != client_id:
+        return
+    for fp in data.get("fps", []):
+        if fp in active_downloads and active_downloads[fp] is None:
+            active_downloads[fp] = data["holder"]
+            threading.Thread(target=download_track, args=(fp, data), daemon=True).start()
+
+
+def serve_chunk_request(data):
+    """Upload chunks (or the manifest) a peer couldn't fetch from us directly."""
+    if data.get("holder") != client_id:
+        return
+    path = library_index.find(fp=data.get("fp"))
+    if path:
+        threading.Thread(target=upload_chunks, daemon=True,
+                         args=(RELAY_URL, room_code, path, data["fp"], data.get("chunks", []))).start()
+
+
+def upload_chunks(relay_url, code, path, fp, indices):
+    try:
+        upload_to_relay(relay_url, code, path, fp, indices)
+    except Exception as e:
+        print(f"⚠️ Upload of {os.path.basename(path)} to the relay failed: {e}")
+
+
+def download_track(fp, offer):
+    """Fetch one track, directly over the LAN when possible, otherwise through the relay."""
+    holder = offer["holder"]
+    relay = RelaySource(RELAY_URL, room_code, lambda fp, chunks: send_command(
+        "chunk_request", data={"holder": holder, "fp": fp, "chunks": chunks}))
+    try:
+        sources, manifest = [], None
+        if offer.get("lan_url"):
+            lan = LanSource(offer["lan_url"])
+            try:
+                manifest = lan.fetch_manifest(fp)
+                sources.append(lan)
+            except Exception as e:
+                print(f"⚠️ Peer not reachable on LAN, using relay: {e}")
+        if manifest is None:
+            manifest = relay.fetch_manifest(fp)
+            sources.append(relay)
+
+        def progress(done, total):
+            root.after(0, lambda: update_status(f"Downloading {manifest['name']}: {done}/{total} chunks"))
+
+        path = Download(manifest, DOWNLOADS_DIR, fp).run(sources, progress=progress)
+        root.after(0, lambda: finish_download(fp, path))
+    except Exception as e:
+        print(f"❌ Download failed for {fp}: {e}")
+        active_downloads.pop(fp, None)  # Allow another request to retry
+        root.after(0, lambda: update_status(f"Download failed: {e}"))
+
+
+def finish_download(fp, path):
+    """Put a downloaded track into the library so the shared queue can play it."""
+    active_downloads.pop(fp, None)
+    add_to_library([path])
+    save_library()
+    update_library_view()
+    refresh_queue_view()
+    update_status(f"Downloaded: {os.path.basename(path)}")
+
+
+# ---------------------------------------
+# STREAMING (host -> listeners without the track)
+# ---------------------------------------
+
+def update_clock_offset(sent_at, received_at, server_time):
+    """Estimate the relay clock from a poll; the lowest round trip gives the best sample."""
+    global clock_offset, best_clock_rtt
+    rtt = received_at - sent_at
+    if best_clock_rtt is None or rtt <= best_clock_rtt * 1.5:
+        best_clock_rtt = rtt if best_clock_rtt is None else min(best_clock_rtt, rtt)
+        clock_offset = server_time - (sent_at + received_at) / 2
+
+
+def room_time():
+    """Current time on the room (relay) clock."""
+    return time.time() + clock_offset
+
+
+def toggle_streaming():
+    global streaming_mode
+    if not room_code or not session_active or not is_host:
+        messagebox.showinfo("Streaming", "Only the host of an active session can stream.")
+        return
+    streaming_mode = not streaming_mode
+    stream_btn.config(text=f"📡 Stream: {'ON' if streaming_mode else 'OFF'}")
+    if streaming_mode and pygame.mixer.music.get_busy() and 0 <= current_index < len(playlist):
+        stream_from_position(resolve_song_path(playlist[current_index]))
+    elif not streaming_mode:
+        stop_stream()
+    update_status(f"Streaming {'enabled' if streaming_mode else 'disabled'}")
+
+
+def start_stream(path, start_seq=0, start_at=None):
+    """Publish the track we are playing so listeners without it can hear it.
+
+    Segment start_seq plays at room time start_at (STREAM_DELAY from now by
+    default); returns that time, or None if the track can't be streamed.
+    """
+    global stream_publisher, stream_info
+    stop_stream()
+    if not os.path.exists(path):
+        return None
+    start_track_server()
+    stream_id = uuid.uuid4().hex[:8]
+
+    def publish(seq, data):
+        if track_server is not None:
+            track_server.publish_segment(stream_id, seq, data)
+        if STREAM_VIA_RELAY and lan_link is None:
+            requests.put(f"{RELAY_URL}/blob/{room_code}/stream.{stream_id}.{seq}", data=data, timeout=10)
+
+    try:
+        stream_publisher = StreamPublisher(path, start_at or room_time() + STREAM_DELAY, room_time, publish, start_seq)
+    except ValueError as e:
+        print(f"⚠️ Not streaming {os.path.basename(path)}: {e}")
+        return None
+    stream_info = {
+        "stream_id": stream_id,
+        "song": path,
+        "fp": fingerprint_cache.get(path, compute=False),
+        "start_at": stream_publisher.start_at,
+        "start_seq": start_seq,
+        "segments": stream_publisher.segments,
+        "segment_seconds": SEGMENT_SECONDS,
+        "ext": os.path.splitext(path)[1] or ".mp3",
+        "lan_url": local_lan_url()
+    }
+    stream_publisher.start()
+    send_command("stream_start", data=stream_info)
+    print(f"📡 Streaming {os.path.basename(path)} from segment {start_seq}")
+    return stream_publisher.start_at
+
+
+def stream_from_position(path):
+    """Stream the track that is already playing, from the first segment we can still publish in time."""
+    position = max(0, pygame.mixer.music.get_pos()) / 1000
+    start_seq = int(-(-(position + STREAM_DELAY) // SEGMENT_SECONDS))
+    start_stream(path, start_seq, room_time() + start_seq * SEGMENT_SECONDS - position)
+
+
+def stop_stream():
+    global stream_publisher, stream_info
+    if stream_publisher is None:
+        return
+    stream_publisher.stop()
+    send_command("stream_stop", data={"stream_id": stream_info["stream_id"]})
+    stream_publisher = None
+    stream_info = None
+
+
+def start_listening(info):
+    """Play the host's stream if we don't own the track ourselves."""
+    global stream_listener
+    if info.get("stream_id") == (stream_info or {}).get("stream_id"):
+        return  # Our own stream
+    if library_index.has(info.get("song", ""), info.get("fp")):
+        return  # We have it and play it locally from the play command
+    stop_listening()
+
+    lan = {"url": info.get("lan_url")}
+    relay_url = f"{RELAY_URL}/blob/{room_code}/stream.{info['stream_id']}"
+
+    def fetch(seq):
+        if lan["url"]:
+            try:
+                res = requests.get(f"{lan['url']}/stream/{info['stream_id']}/{seq}", timeout=1)
+                if res.status_code == 200:
+                    return res.content
+            except requests.exceptions.RequestException:
+                lan["url"] = None  # Not reachable directly, stick to the relay
+        res = requests.get(f"{relay_url}.{seq}", timeout=5)
+        return res.content if res.status_code == 200 else None
+
+    def play(path):
+        pygame.mixer.music.load(path)
+        pygame.mixer.music.play()
+
+    player = types.SimpleNamespace(play=play, queue=pygame.mixer.music.queue,
+                                   is_busy=pygame.mixer.music.get_busy)
+    stream_listener = StreamListener(info, room_time, fetch, player, info.get("ext", ".mp3")).start()
+    root.after(0, report_stream_stats)
+    print(f"📡 Listening to host stream of {os.path.basename(info.get('song', ''))}")
+
+
+def stop_listening():
+    global stream_listener
+    if stream_listener is not None:
+        stream_listener.stop()
+        stream_listener = None
+
+
+def report_stream_stats():
+    """Show jitter buffer depth, underruns and latency while listening."""
+    if stream_listener is None:
+        return
+    stats = stream_listener.buffer.stats()
+    update_status(f"📡 {os.path.basename(stream_listener.info.get('song', ''))} • "
+                  f"buffer {stats['depth']:.0f}s • underruns {stats['underruns']} • "
+                  f"latency {stats['latency_ms']} ms")
+    print(f"📡 Stream stats: {stats}")
+    root.after(2000, report_stream_stats)
+
+
 def wake_up_server():
     """Manually wake up the relay server."""
     update_status("Waking up relay server...")
@@ -852,18 +1450,49 @@ def wake_up_server():
 # NETWORK RELAY FUNCTIONS
 # ---------------------------------------
 
+def room_relay(code, refresh=False):
+    """URL of the relay node that owns room `code` (relay_seed unless the relay is sharded).
+
+    The node list comes from relay_seed, never from a node we were sent to,
+    so losing that node doesn't lose the way back in.
+    """
+    global relay_ring
+    if relay_ring is None or relay_ring[0] != relay_seed or refresh:
+        ring = relay_ring[1] if relay_ring and relay_ring[0] == relay_seed else None
+        try:
+            res = requests.get(f"{relay_seed}/ring", timeout=10)
+            if res.status_code == 200:
+                ring = HashRing(res.json()["nodes"])
+        except Exception as e:
+            print(f"⚠️ Could not fetch the relay's node list: {e}")
+        relay_ring = (relay_seed, ring)
+    ring = relay_ring[1]
+    return (ring and ring.node_for(code)) or relay_seed
+
+
+def follow_relay_redirect(res):
+    """A sharded relay sent us to the room's node: talk to that node directly from now on."""
+    global RELAY_URL, relay_ring
+    if res.history:
+        url = urlparse(res.url)
+        RELAY_URL = f"{url.scheme}://{url.netloc}"
+        relay_ring = None  # nodes were added or removed, fetch the list again next time
+        print(f"🔀 Our room is served by relay node {RELAY_URL}")
+
+
 def host_session():
     global room_code, session_active, is_host
     try:
         update_status("Connecting to relay server...")
-        res = requests.post(f"{RELAY_URL}/host", timeout=30)  # Increased timeout for cold start
+        res = requests.post(f"{RELAY_URL}/host", json={"client": client_id}, timeout=30)  # Increased timeout for cold start
+        follow_relay_redirect(res)
         data = res.json()
         room_code = data["room_code"]
         is_host = True
         session_active = True
         update_status(f"Hosting session • Room code: {room_code}")
-        start_keep_alive()
-        threading.Thread(target=poll_commands, daemon=True).start()
+        start_track_server()
+        threading.Thread(target=poll_commands, args=(data.get("seq", 0), data.get("epoch")), daemon=True).start()
     except requests.exceptions.Timeout:
         update_status("Connection timeout - relay server may be sleeping. Try again in 30 seconds.")
         messagebox.showerror("Connection Timeout", 
@@ -875,22 +1504,50 @@ def host_session():
         messagebox.showerror("Connection Failed", f"Could not connect to relay server:\n\n{str(e)}")
 
 
+def host_local_session():
+    """Run the relay inside this app and host the room on it (no cloud relay, no cold start)."""
+    global RELAY_URL, relay_seed, local_relay
+    if local_relay is None:
+        setup_logging()  # relay events (members leaving, host changes) on the console
+        try:
+            local_relay = serve_in_background(port=LOCAL_RELAY_PORT)
+        except OSError:
+            local_relay = serve_in_background(port=0)  # Port taken, let the OS pick one
+        print(f"✅ Local relay listening on port {local_relay.port}")
+    RELAY_URL = relay_seed = f"http://127.0.0.1:{local_relay.port}"
+    host_session()
+    if session_active:
+        # Others join with CODE@address so their client talks to our relay
+        address = f"{local_ip() or '127.0.0.1'}:{local_relay.port}"
+        update_status(f"Hosting locally • Join code: {room_code}@{address}")
+        room_entry.delete(0, END)
+        room_entry.insert(0, f"{room_code}@{address}")
+
+
 def join_session():
-    global room_code, session_active, is_host
+    global room_code, session_active, is_host, RELAY_URL, relay_seed
     code = room_entry.get().strip()
     if not code:
         update_status("Please enter a room code.")
         return
+    relay_seed = RELAY_SEED_URL
+    if "@" in code:
+        # CODE@host:port joins a room hosted on someone's local relay
+        code, address = code.split("@", 1)
+        relay_seed = f"http://{address}"
     try:
         update_status("Connecting to relay server...")
-        res = requests.post(f"{RELAY_URL}/join/{code}", timeout=30)  # Increased timeout
+        RELAY_URL = room_relay(code)
+        res = requests.post(f"{RELAY_URL}/join/{code}", json={"client": client_id}, timeout=30)  # Increased timeout
         if res.status_code == 200:
             room_code = code
+            follow_relay_redirect(res)
             is_host = False
             session_active = True
             update_status(f"Joined room: {room_code}")
-            start_keep_alive()
-            threading.Thread(target=poll_commands, daemon=True).start()
+            start_track_server()
+            data = res.json()
+            threading.Thread(target=poll_commands, args=(data.get("seq", 0), data.get("epoch")), daemon=True).start()
         else:
             update_status("Room not found.")
             messagebox.showerror("Room Not Found", f"Room code '{code}' does not exist.")
@@ -904,77 +1561,369 @@ def join_session():
         messagebox.showerror("Connection Failed", f"Could not connect to relay server:\n\n{str(e)}")
 
 
-def send_command(command, index=None, data=None):
-    """Send a command to the relay server."""
+def host_lan_session():
+    """Host a session on the local network; this client becomes the room's relay."""
+    global room_code, session_active, is_host, lan_link
+    if session_active:
+        messagebox.showinfo("Already Connected", "Leave the current session first.")
+        return
+    try:
+        code = uuid.uuid4().hex[:6].upper()
+        lan_link = LanHub(code, on_lan_command, name=socket.gethostname()).start()
+    except OSError as e:
+        messagebox.showerror("LAN Host Failed", f"Could not open a LAN session:\n\n{e}")
+        return
+    room_code = code
+    is_host = True
+    session_active = True
+    start_track_server()
+    update_status(f"Hosting LAN session • Room code: {room_code}")
+
+
+def join_lan_session():
+    """Find a LAN session by broadcast and connect to its host directly."""
+    global room_code, session_active, is_host, lan_link
+    if session_active:
+        messagebox.showinfo("Already Connected", "Leave the current session first.")
+        return
+    update_status("Looking for LAN sessions...")
+    root.update_idletasks()
+    try:
+        found = discover_rooms()
+    except OSError as e:
+        messagebox.showerror("LAN Discovery Failed", f"Could not listen for LAN sessions:\n\n{e}")
+        return
+    if not found:
+        update_status("No LAN sessions found.")
+        messagebox.showinfo("No Sessions", "No sessions found on this network.")
+        return
+
+    room = found[0]
+    if len(found) > 1:
+        code = simpledialog.askstring(
+            "Join LAN Session",
+            "Sessions on this network:\n" + "\n".join(f"{r['room_code']} ({r['name']})" for r in found)
+            + "\n\nEnter room code:"
+        )
+        room = next((r for r in found if code and r["room_code"] == code.strip().upper()), None)
+        if room is None:
+            return
+
+    try:
+        lan_link = LanClient(room["host"], room["port"], on_lan_command,
+                             on_clock=update_clock_offset, on_disconnect=on_lan_disconnect).start()
+    except OSError as e:
+        messagebox.showerror("Connection Failed", f"Could not connect to LAN host:\n\n{e}")
+        return
+    room_code = room["room_code"]
+    is_host = False
+    session_active = True
+    start_track_server()
+    update_status(f"Joined LAN room: {room_code}")
+
+
+def leave_lan_session():
+    """End our LAN session: close the hub (dropping every peer) or our link to it."""
+    global room_code, session_active, is_host, lan_link
+    if lan_link is None:
+        update_status("Not in a LAN session.")
+        return
+    stop_stream()  # Tells the room while the link is still up
+    stop_listening()
+    link, lan_link = lan_link, None
+    if isinstance(link, LanHub):
+        link.stop()
+    else:
+        link.close()
+    room_code = None
+    is_host = False
+    session_active = False
+    update_status("Left the LAN session.")
+
+
+def on_lan_command(cmd_data):
+    # LAN sockets deliver on their own threads, run the command on the Tk thread
+    root.after(0, lambda: process_command(cmd_data))
+
+
+def on_lan_disconnect():
+    global room_code, session_active, is_host, lan_link
+    session_active = False
+    lan_link = None
+    room_code = None
+    is_host = False
+    root.after(0, lambda: update_status("⚠️ LAN host disconnected"))
+
+
+def post_command(payload, retries=0):
+    """POST one command to the relay; True once the relay has it (or has refused it for good).
+
+    A timed-out POST may still have been stored, resending it is safe because
+    the relay drops ids it has already seen.
+    """
+    for attempt in range(retries + 1):
+        try:
+            response = requests.post(f"{RELAY_URL}/send/{room_code}", json=payload, timeout=5)
+            follow_relay_redirect(response)
+            break
+        except Exception as e:
+            print(f"❌ Send failed (attempt {attempt + 1}/{retries + 1}): {e}")
+            if attempt < retries:
+                time.sleep(0.2 * (attempt + 1))
+    else:
+        return False
+    print(f"📤 Sent command: {payload['command']} (status: {response.status_code})")
+    if response.status_code == 429:
+        # Relay asks us to slow down: keep it in the journal for the next flush
+        print(f"⏳ Rate limited, retry after {response.headers.get('Retry-After', '?')}s")
+        return False
+    if response.status_code == 413:
+        command_too_large(payload)
+    elif response.status_code != 200:
+        print(f"⚠️ Server response: {response.text}")
+    # Other client errors won't get better by retrying, only 5xx (e.g. relay waking up) is kept
+    return response.status_code < 500
+
+
+def command_too_large(payload):
+    """The relay refused a command for its size: never silently, a queue edit goes out as a snapshot."""
+    print(f"❌ Command too large for the relay: {payload['command']}")
+    if payload["command"] == "queue_ops":
+        root.after(0, lambda: send_command("sync_playlist", data=queue_snapshot()))
+    else:
+        root.after(0, lambda: update_status(f"❌ Not shared with the room (too large): {payload['command']}"))
+
+
+def journal_command(payload):
+    """Keep a command for replay once the relay is reachable again (called on the sender thread)."""
+    outbound_journal.add(payload)
+    if payload["command"] == "queue_ops":
+        # Replaying every edit isn't needed, the final queue state is. The
+        # snapshot is taken on the Tk thread, which owns queue_doc, and replaces
+        # the journaled edits when it is added
+        root.after(0, lambda: outbound_journal.add(
+            {"command": "sync_playlist", "data": queue_snapshot(), "id": new_command_id()}))
+    root.after(0, lambda: update_status(f"⚠️ Offline • {len(outbound_journal)} command(s) waiting for the relay"))
+
+
+def flush_outbound_journal():
+    """Replay journaled commands in order (on the sender thread)."""
+    if len(outbound_journal):
+        sent = outbound_journal.flush(post_command)
+        if sent:
+            print(f"📤 Replayed {sent} offline command(s)")
+
+
+def send_command(command, index=None, data=None, to=None):
+    """Send a command to the relay server (journaled for later if it is unreachable).
+
+    to is a list of member client ids to address it to; None means the whole room.
+    """
     if not room_code or not session_active:
         print("⚠️ Cannot send command: Not in active session")
         return
-    try:
-        payload = {"command": command}
-        if index is not None:
-            payload["index"] = index
-        if data is not None:
-            payload["data"] = data
-        
-        response = requests.post(f"{RELAY_URL}/send/{room_code}", json=payload, timeout=5)
-        print(f"📤 Sent command: {command} (status: {response.status_code})")
-        
-        if response.status_code != 200:
-            print(f"⚠️ Server response: {response.text}")
-    except Exception as e:
-        print(f"❌ Send failed: {e}")
+    # The id lets the relay recognise a retry of a command it already stored,
+    # origin lets the relay (and everyone else) skip our own commands in O(1)
+    payload = {"command": command, "id": new_command_id(),
+               "origin": client_id, "origin_seq": next(outbound_seq)}
+    if index is not None:
+        payload["index"] = index
+    if data is not None:
+        payload["data"] = data
+    if to is not None:
+        payload["to"] = to
+    poll_scheduler.note_activity()
+
+    if lan_link is not None:
+        # LAN session: straight to the hub / peers over TCP
+        try:
+            lan_link.send(payload)
+            print(f"📤 Sent command over LAN: {command}")
+        except Exception as e:
+            print(f"❌ Send failed: {e}")
+        return
+
+    # A POST can take seconds while the relay wakes up or retries, so the
+    # Tk and poll threads only queue the command for the sender thread
+    start_sender()
+    outbox.put(payload)
+
+
+def start_sender():
+    global sender_thread
+    if sender_thread is None:
+        sender_thread = threading.Thread(target=sender_loop, daemon=True)
+        sender_thread.start()
+
+
+def sender_loop():
+    """Post queued commands to the relay one at a time, in the order they were sent."""
+    while True:
+        payload = outbox.get()
+        # Earlier commands still waiting go first so the room sees them in order
+        flush_outbound_journal()
+        if payload is not None and (len(outbound_journal) or not post_command(payload, SEND_RETRIES)):
+            journal_command(payload)
+
+
+def reopen_room():
+    """Recreate our room on a relay that restarted, or join it if a peer already has.
+
+    Returns the new room's (seq, epoch).
+    """
+    res = requests.post(f"{RELAY_URL}/host", json={"room_code": room_code, "client": client_id}, timeout=30)
+    if res.status_code == 409:
+        res = requests.post(f"{RELAY_URL}/join/{room_code}", json={"client": client_id}, timeout=30)
+    res.raise_for_status()
+    follow_relay_redirect(res)
+    data = res.json()
+    print(f"🔁 Room {room_code} reopened on the relay")
+    return data.get("seq", 0), data.get("epoch")
+
 
+def request_snapshot():
+    """Ask the room for its current queue after missing commands we can't replay."""
+    print("🔁 Missed commands are no longer on the relay, requesting a snapshot")
+    send_command("request_snapshot", data={"client": client_id, "from_host": is_host})
 
-def poll_commands():
-    """Poll for commands from the relay server."""
-    global session_active
+
+def answer_snapshot_request(data):
+    # The host answers; if the host itself fell behind, everyone else does
+    if data.get("client") == client_id:
+        return
+    if is_host or data.get("from_host"):
+        send_command("sync_playlist", data=queue_snapshot())
+
+
+def on_host_changed(data):
+    """The relay promoted a new host after the previous one went silent."""
+    global is_host, streaming_mode
+    was_host = is_host
+    is_host = data.get("host") == client_id
+    if is_host and not was_host:
+        # Our replica of the queue is the room's latest state; share it so
+        # anyone who fell behind converges without a re-host
+        print(f"👑 Promoted to host (previous host {data.get('previous')} went silent)")
+        update_status(f"👑 You are now the host of room {room_code}")
+        send_command("sync_playlist", data=queue_snapshot())
+    elif was_host and not is_host:
+        # We were silent long enough to be replaced, hand over cleanly
+        streaming_mode = False
+        root.after(0, lambda: stream_btn.config(text="📡 Stream: OFF"))
+        stop_stream()
+        update_status(f"Host role moved to another member of room {room_code}")
+
+
+def poll_commands(last_seq=0, epoch=None):
+    """Poll for commands from the relay server.
+
+    Resumes from the last sequence number we applied, so after a dropped
+    connection (or a relay restart) the next successful poll replays exactly
+    what we missed. Failed polls back off exponentially via poll_scheduler.
+    """
+    global session_active, RELAY_URL
     consecutive_errors = 0
     max_consecutive_errors = 3
-    last_poll_timestamp = 0  # <-- NEW: Track last poll time
     
     while session_active:
         try:
-            # <-- MODIFIED: Send 'since' timestamp
+            sent_at = time.time()
             res = requests.get(
-                f"{RELAY_URL}/receive/{room_code}?since={last_poll_timestamp}", 
+                f"{RELAY_URL}/receive/{room_code}",
+                params={"after": last_seq, "client": client_id},  # the poll is also our presence heartbeat
                 timeout=10
             )
+            follow_relay_redirect(res)
+            if res.status_code == 404:
+                # Relay restarted and lost the room (or the room moved to a node
+                # added to a sharded relay): bring it back, then catch up from peers
+                last_seq, epoch = reopen_room()
+                request_snapshot()
+                res = requests.get(
+                    f"{RELAY_URL}/receive/{room_code}",
+                    params={"after": last_seq, "client": client_id},
+                    timeout=10
+                )
+            res.raise_for_status()
             
             data = res.json()
             commands = data.get("commands", [])
             
-            # <-- NEW: Update timestamp to server's time
-            # We use the server's returned time to avoid clock-skew issues
+            # The server's time drives the room clock
             new_timestamp = data.get("timestamp")
             if new_timestamp:
-                last_poll_timestamp = new_timestamp
-            else:
-                # Fallback in case 'timestamp' is missing
-                print("⚠️ Server did not return a timestamp, using local time.")
-                last_poll_timestamp = time.time()
+                update_clock_offset(sent_at, time.time(), new_timestamp)
 
+            if data.get("gap") or (epoch is not None and data.get("epoch") != epoch):
+                request_snapshot()
+            epoch = data.get("epoch", epoch)
             
             if commands:
                 print(f"📥 Received {len(commands)} command(s)")
             for cmd_data in commands:
                 print(f"📥 Processing: {cmd_data}")
-                process_command(cmd_data)
+                # The Tk thread is the only writer of the queue and the widgets
+                root.after(0, process_command, cmd_data)
+            # The reply covers everything up to the room's seq, including our own
+            # commands the relay left out
+            last_seq = data.get("seq", last_seq)
+            if data.get("host") and (data["host"] == client_id) != is_host:
+                root.after(0, on_host_changed, {"host": data["host"]})  # missed the host_changed command
             
+            if consecutive_errors >= max_consecutive_errors:
+                root.after(0, lambda: update_status(f"✅ Reconnected to room {room_code}"))
+            if len(outbound_journal) and outbox.empty():
+                start_sender()
+                outbox.put(None)  # Relay is back: replay what was journaled
             # Reset error counter on success
             consecutive_errors = 0
+            poll_scheduler.note_success(bool(commands))
             
         except requests.exceptions.Timeout:
             consecutive_errors += 1
+            poll_scheduler.note_error()
             print(f"⚠️ Poll timeout ({consecutive_errors}/{max_consecutive_errors})")
             if consecutive_errors >= max_consecutive_errors:
-                root.after(0, lambda: update_status("⚠️ Connection unstable - relay may be sleeping"))
+                root.after(0, lambda: update_status("⚠️ Connection unstable - relay may be sleeping, retrying..."))
+        except requests.exceptions.ConnectionError as e:
+            consecutive_errors += 1
+            poll_scheduler.note_error()
+            print(f"❌ Relay node unreachable ({consecutive_errors}/{max_consecutive_errors}): {e}")
+            # The node may be gone from a sharded relay: after every few failures in a row, ask the
+            # seed who owns the room now (the new owner answers 404 and we reopen the room there).
+            # In between, poll_scheduler backs the retries off.
+            if consecutive_errors % max_consecutive_errors == 0:
+                RELAY_URL = room_relay(room_code, refresh=True)
+            if consecutive_errors >= max_consecutive_errors:
+                root.after(0, lambda: update_status("⚠️ Connection lost to relay server, reconnecting..."))
         except Exception as e:
             consecutive_errors += 1
+            poll_scheduler.note_error()
             print(f"❌ Poll error ({consecutive_errors}/{max_consecutive_errors}): {e}")
             if consecutive_errors >= max_consecutive_errors:
-                root.after(0, lambda: update_status("⚠️ Connection lost to relay server"))
-        
-        time.sleep(POLL_INTERVAL)
+                root.after(0, lambda: update_status("⚠️ Connection lost to relay server, reconnecting..."))
+
+        # Fast while the room is busy, backing off (with jitter) while it is idle or unreachable
+        poll_scheduler.wait()
+
+
+def play_remote_index(index, label, start_at=None):
+    """Play a queue entry because another client did (at room time start_at when given)."""
+    global current_index, paused
+    if not 0 <= index < len(playlist):
+        return
+    current_index = index
+    refresh_queue_view()
+    song_path = resolve_song_path(playlist[current_index])
+    if not os.path.exists(song_path):
+        # Not in our library: the host's stream (if any) plays it instead
+        update_status(f"Not in your library: {os.path.basename(playlist[current_index])}")
+        return
+    stop_listening()
+    pygame.mixer.music.load(song_path)
+    play_at(start_at)
+    paused = False
+    update_status(f"{label}: {os.path.basename(playlist[current_index])}")
 
 
 def process_command(cmd_data):
@@ -985,22 +1934,29 @@ def process_command(cmd_data):
         command = cmd_data
         index = None
         data = None
+        origin = None
     else:
         command = cmd_data.get("command", "")
         index = cmd_data.get("index")
         data = cmd_data.get("data")
+        origin = cmd_data.get("origin")
+        # Our own command coming back (older relays and LAN peers don't filter it)
+        if origin == client_id:
+            return
+        # Addressed to other members only
+        if cmd_data.get("to") is not None and client_id not in cmd_data["to"]:
+            return
+        # A resent or replayed command we already applied
+        if cmd_data.get("id") and applied_command_ids.seen(cmd_data["id"]):
+            print(f"↩️ Ignoring duplicate command {cmd_data['id']}")
+            return
     
     print(f"Processing command: {command}, index: {index}, data: {data is not None}")
     
     if command == "play" and index is not None:
-        if 0 <= index < len(playlist):
-            current_index = index
-            pygame.mixer.music.load(playlist[current_index])
-            pygame.mixer.music.play()
-            paused = False
-            refresh_queue_view()
-            update_status(f"Playing: {os.path.basename(playlist[current_index])}")
+        play_remote_index(index, "Playing", (data or {}).get("at"))
     elif command == "pause":
+        cancel_pending_play()
         pygame.mixer.music.pause()
         paused = True
         update_status("Paused")
@@ -1009,37 +1965,44 @@ def process_command(cmd_data):
         paused = False
         update_status("Resumed")
     elif command == "stop":
+        cancel_pending_play()
         pygame.mixer.music.stop()
         update_status("Stopped")
     elif command == "next" and index is not None:
-        if 0 <= index < len(playlist):
-            current_index = index
-            pygame.mixer.music.load(playlist[current_index])
-            pygame.mixer.music.play()
-            paused = False
-            refresh_queue_view()
-            update_status(f"Skipped to: {os.path.basename(playlist[current_index])}")
+        play_remote_index(index, "Skipped to", (data or {}).get("at"))
     elif command == "prev" and index is not None:
-        if 0 <= index < len(playlist):
-            current_index = index
-            pygame.mixer.music.load(playlist[current_index])
-            pygame.mixer.music.play()
-            paused = False
-            refresh_queue_view()
-            update_status(f"Previous: {os.path.basename(playlist[current_index])}")
+        play_remote_index(index, "Previous", (data or {}).get("at"))
+    elif command == "stream_start":
+        if data is not None:
+            start_listening(data)
+    elif command == "stream_stop":
+        if data is not None and stream_listener and stream_listener.info.get("stream_id") == data.get("stream_id"):
+            stop_listening()
+    elif command == "queue_ops":
+        if data is not None:
+            apply_remote_queue_ops(data.get("ops", []))
+    elif command == "host_changed":
+        if data is not None:
+            on_host_changed(data)
+    elif command == "request_snapshot":
+        if data is not None:
+            answer_snapshot_request(data)
     elif command == "sync_playlist":
         if data is not None:
             # Receive synced playlist
             received_playlist = data.get("playlist", [])
             received_index = data.get("current_index", 0)
+
+            # Full queue state from a current client: merge it, no prompt needed
+            if data.get("queue_state") is not None:
+                apply_remote_queue_state(data["queue_state"], data.get("fingerprints"))
+                return
             
-            # --- THIS IS THE FIX ---
-            # If the received playlist is identical to our current one,
-            # we are the sender (or already in sync). Ignore it.
+            # Our own syncs never get here (origin check above); a peer's
+            # identical queue needs no prompt either
             if received_playlist == playlist:
-                print("✅ Ignoring self-sent or identical playlist sync.")
+                print("✅ Ignoring identical playlist sync.")
                 return
-            # --- END FIX ---
 
             # Compare and show what's missing
             compare_playlists(received_playlist)
@@ -1053,17 +2016,46 @@ def process_command(cmd_data):
             )
             
             if response:
-                playlist = received_playlist.copy()
+                queue_doc.replace(received_playlist)
+                refresh_from_queue_doc()
                 current_index = received_index if 0 <= received_index < len(playlist) else 0
                 refresh_queue_view()
                 save_playlist()
                 update_status("Playlist synced successfully!")
         else:
             print("⚠️ sync_playlist received but data is None")
+    elif command == "track_request":
+        if data is not None:
+            offer_tracks(data)
+    elif command == "track_offer":
+        if data is not None:
+            accept_track_offer(data)
+    elif command == "chunk_request":
+        if data is not None:
+            serve_chunk_request(data)
     elif command == "request_library":
-        # Someone requested our library, send it back
-        print("📨 Received library request, sending our library...")
-        send_library_comparison(is_reply=True)
+        if data is not None and "sketch" in data:
+            # Sketch-based request: answer with the difference only
+            print("📨 Received library sketch, reconciling...")
+            answer_library_sketch(data, origin)
+        else:
+            # Someone requested our library, send it back
+            print("📨 Received library request, sending our library...")
+            send_library_comparison(is_reply=True, to=[origin] if origin else None)
+    elif command == "library_sketch_retry":
+        token = data.get("token") if data else None
+        # Addressed to us by the one peer that needs it, so every retry is answered
+        if token in pending_reconciliations and data.get("cells", 0) > MIN_CELLS:
+            print(f"📨 Peer needs a bigger library sketch ({data['cells']} cells)")
+            send_library_sketch(token, data["cells"], to=[origin] if origin else None)
+    elif command == "library_diff":
+        if data is not None:
+            receive_library_diff(data, origin)
+    elif command == "library_diff_reply":
+        if data is not None and data.get("answer") in answered_reconciliations:
+            _, only_local, _ = answered_reconciliations.pop(data["answer"])
+            show_comparison_results(data.get("library_count", 0), only_local, data.get("only_sender", []),
+                                    len(library_keys()))
     elif command == "library_comparison":
         if data is not None:
             is_reply = data.get("is_reply", False)
@@ -1074,7 +2066,7 @@ def process_command(cmd_data):
             # Only auto-reply if this wasn't already a reply (prevent loop)
             if not is_reply:
                 print("📤 Auto-replying with our library...")
-                send_library_comparison(is_reply=True)
+                send_library_comparison(is_reply=True, to=[origin] if origin else None)
             else:
                 print("✅ This was a reply, not sending another response (loop prevention)")
         else:
@@ -1082,24 +2074,6 @@ def process_command(cmd_data):
             print(f"Full command data: {cmd_data}")
 
 
-def keep_alive():
-    """Keep the relay server connection alive."""
-    while session_active:
-        try:
-            requests.get(f"{RELAY_URL}/ping", timeout=10)
-            print("🟢 Relay pinged (alive)")
-        except requests.exceptions.Timeout:
-            print("🟡 Ping timeout - server may be slow")
-        except Exception as e:
-            print(f"🔴 Ping failed: {e}")
-        time.sleep(KEEP_ALIVE_INTERVAL)
-
-
-def start_keep_alive():
-    threading.Thread(target=keep_alive, daemon=True).start()
-
-
-
 # ---------------------------------------
 # TKINTER UI
 # ---------------------------------------
@@ -1193,6 +2167,9 @@ session_frame.grid(row=1, column=0, columnspan=3, pady=5)
 host_btn = Button(session_frame, text="Host Session", command=host_session)
 host_btn.pack(side=LEFT, padx=5)
 
+host_local_btn = Button(session_frame, text="Host Locally", command=host_local_session)
+host_local_btn.pack(side=LEFT, padx=5)
+
 join_label = Label(session_frame, text="Join Code:")
 join_label.pack(side=LEFT, padx=5)
 
@@ -1202,6 +2179,15 @@ room_entry.pack(side=LEFT, padx=5)
 join_btn = Button(session_frame, text="Join", command=join_session)
 join_btn.pack(side=LEFT, padx=5)
 
+# LAN controls (no internet / relay needed)
+lan_frame = Frame(network_frame)
+lan_frame.grid(row=3, column=0, columnspan=3, pady=5)
+
+Label(lan_frame, text="Same network:").pack(side=LEFT, padx=5)
+Button(lan_frame, text="🏠 Host on LAN", command=host_lan_session).pack(side=LEFT, padx=5)
+Button(lan_frame, text="🔍 Join LAN Session", command=join_lan_session).pack(side=LEFT, padx=5)
+Button(lan_frame, text="🚪 Leave LAN Session", command=leave_lan_session).pack(side=LEFT, padx=5)
+
 # Sync controls
 sync_frame = Frame(network_frame)
 sync_frame.grid(row=2, column=0, columnspan=3, pady=5)
@@ -1219,13 +2205,20 @@ share_saved_btn.pack(side=LEFT, padx=5)
 compare_lib_btn = Button(sync_frame, text="📊 Compare Libraries", command=compare_libraries)
 compare_lib_btn.pack(side=LEFT, padx=5)
 
+stream_btn = Button(sync_frame, text="📡 Stream: OFF", command=toggle_streaming)
+stream_btn.pack(side=LEFT, padx=5)
+
 # Initialize the app with saved data
 update_library_view() # <-- Use new name
 
 # Load the last playlist state
-saved_playlist, saved_index = load_saved_playlist()
+saved_playlist, saved_index, saved_queue_state = load_saved_playlist()
+if saved_queue_state:
+    queue_doc.merge_state(saved_queue_state)
+else:
+    queue_doc.replace(saved_playlist)
 if saved_playlist:
-    playlist = saved_playlist
+    playlist = queue_doc.songs()
     current_index = saved_index if 0 <= saved_index < len(playlist) else 0
     refresh_queue_view()
     update_status("Loaded previous session")
@@ -1234,6 +2227,10 @@ if saved_playlist:
 # This makes the search bar update the list every time you type
 search_var.trace_add("write", update_library_view)
 
+# Fingerprint new or changed library files in the background, then cache them
+fingerprint_cache.start_background(
+    library, on_done=lambda changed: changed and root.after(0, save_library))
+
 check_song_end()
 root.mainloop()
 